@@ -1,39 +1,73 @@
-import boto3
+import aws_clients
 import json
+from instrumentation import instrumented
 
-sns = boto3.client('sns')
+sns = aws_clients.client('sns')
 topic_arn = 'arn:aws:sns:ap-southeast-2:992382579935:ImageTagNotifications'
 
+# 反向索引: 每个 (tag, 用户) 一条记录, 新图片的标签可以直接查到订阅者
+subscribers_table = aws_clients.table('tag-subscribers')
+
+def stream_tags(image):
+    # 订阅标签可能是列表 (L) 也可能是字符串集合 (SS)
+    raw_data = image.get('subscribed_tags', {})
+    if 'SS' in raw_data:
+        return list(raw_data['SS'])
+    return [S_tag.get('S') for S_tag in raw_data.get('L', [])]
+
+def update_reverse_index(user_email, old_tags, new_tags):
+    old_tags = {tag.strip().lower() for tag in old_tags}
+    new_tags = {tag.strip().lower() for tag in new_tags}
+    with subscribers_table.batch_writer() as batch:
+        for tag in new_tags - old_tags:
+            batch.put_item(Item={'tag': tag, 'user_email': user_email})
+        for tag in old_tags - new_tags:
+            batch.delete_item(Key={'tag': tag, 'user_email': user_email})
+
+@instrumented
 def lambda_handler(event, context):
     for record in event['Records']:
+        if record['eventName'] == 'REMOVE':
+            old_image = record['dynamodb'].get('OldImage', {})
+            user_email = record['dynamodb']['Keys']['id']['S']
+            # 失败时抛出异常, stream 会重试这批记录, 反向索引不会和 user-tags 不一致
+            update_reverse_index(user_email, stream_tags(old_image), [])
+
         if record['eventName'] in ['INSERT', 'MODIFY']:
             new_image = record['dynamodb']['NewImage']
             user_email = new_image['id']['S']  # 假设 'id' 是用户电子邮件的属性名
-            raw_data = new_image['subscribed_tags']['L']  # 订阅标签列表
-            subscribed_tags = [S_tag.get('S') for S_tag in raw_data]
+            subscribed_tags = stream_tags(new_image)  # 订阅标签列表
+            old_image = record['dynamodb'].get('OldImage', {})
+            old_tags = stream_tags(old_image)
             print("User Email:", user_email)
             print("Subscribed Tags:", subscribed_tags)
 
+            # 先更新反向索引, 失败就抛出, 重试时不会重复发送欢迎或更新邮件
+            update_reverse_index(user_email, old_tags, subscribed_tags)
+
+            # 只发给这个用户: 订阅带有 user_email 过滤策略, 消息带同名属性
+            message_attributes = {
+                'user_email': {'DataType': 'String', 'StringValue': user_email}
+            }
+
             try:
                 # 在 INSERT 事件时订阅用户到SNS主题并发送确认邮件
                 if record['eventName'] == 'INSERT':
                     sns.subscribe(
                         TopicArn=topic_arn,
                         Protocol='email',
-                        Endpoint=user_email
+                        Endpoint=user_email,
+                        Attributes={'FilterPolicy': json.dumps({'user_email': [user_email]})}
                     )
                     message = f"Welcome! You've subscribed to tags: {', '.join(subscribed_tags)}."
                     subject = "Subscription Confirmation"
                     sns.publish(
                         TopicArn=topic_arn,
                         Message=message,
-                        Subject=subject
+                        Subject=subject,
+                        MessageAttributes=message_attributes
                     )
                 else:  # MODIFY 事件
-                    old_image = record['dynamodb'].get('OldImage', {})
-                    old_tags_raw = old_image.get('subscribed_tags', {}).get('L', [])
-                    old_tags = [S_tag.get('S') for S_tag in old_tags_raw]
-
                     # 只有在标签实际变化时才发送更新通知
                     if set(old_tags) != set(subscribed_tags):
                         message = f"Your subscription tags have been updated to: {', '.join(subscribed_tags)}."
@@ -41,7 +75,8 @@ def lambda_handler(event, context):
                         sns.publish(
                             TopicArn=topic_arn,
                             Message=message,
-                            Subject=subject
+                            Subject=subject,
+                            MessageAttributes=message_attributes
                         )
             except Exception as e:
                 print(f"Error in subscribing or notifying {user_email}: {str(e)}")
@@ -0,0 +1,267 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda-functions'))
+
+from bench_postprocess import make_layer_outputs
+from thumbnails import DETECTION_SIZE, THUMBNAIL_SIZES, decode_image, encode, make_renditions
+from yolo_postprocess import postprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG_PATH = os.path.join(BENCH_DIR, 'yolov3-tiny.cfg')
+RESOLUTIONS = ['640x480', '1920x1080', '4032x3024']
+
+
+def parse_cfg(path):
+    # darknet cfg as a list of (section, options), [net] included
+    sections = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            if line.startswith('['):
+                sections.append((line[1:-1], {}))
+            else:
+                key, value = line.split('=', 1)
+                sections[-1][1][key.strip()] = value.strip()
+    return sections
+
+
+def write_random_weights(config_path, weights_path, seed=0):
+    # Darknet weights with the layout of the config but random values: no
+    # download needed, and forward() does exactly the same arithmetic as
+    # with the trained weights. Only the detections are meaningless.
+    rng = np.random.default_rng(seed)
+    sections = parse_cfg(config_path)
+    channels = [int(sections[0][1].get('channels', 3))]
+    layer_channels = []
+    with open(weights_path, 'wb') as f:
+        # major, minor, revision, then a 64 bit count of images seen
+        np.array([0, 2, 0], dtype=np.int32).tofile(f)
+        np.array([0], dtype=np.int64).tofile(f)
+        for name, options in sections[1:]:
+            if name == 'convolutional':
+                filters = int(options['filters'])
+                size = int(options['size'])
+                fan_in = channels[-1] * size * size
+                if options.get('batch_normalize') == '1':
+                    # biases, scales, rolling mean, rolling variance
+                    np.zeros(filters, np.float32).tofile(f)
+                    np.ones(filters, np.float32).tofile(f)
+                    np.zeros(filters, np.float32).tofile(f)
+                    np.ones(filters, np.float32).tofile(f)
+                else:
+                    np.zeros(filters, np.float32).tofile(f)
+                scale = np.sqrt(2.0 / fan_in) if options.get('activation') == 'leaky' else 0.1 / np.sqrt(fan_in)
+                (rng.standard_normal(filters * fan_in) * scale).astype(np.float32).tofile(f)
+                out = filters
+            elif name == 'route':
+                layers = [int(layer) for layer in options['layers'].split(',')]
+                out = sum(layer_channels[layer] if layer >= 0 else layer_channels[len(layer_channels) + layer]
+                          for layer in layers)
+            else:
+                # maxpool, upsample, shortcut and yolo keep the channel count
+                out = channels[-1]
+            layer_channels.append(out)
+            channels.append(out)
+
+
+def load_net(config_path, weights_path):
+    net = cv2.dnn.readNetFromDarknet(config_path, weights_path)
+    names = net.getLayerNames()
+    output_layers = [names[i - 1] for i in net.getUnconnectedOutLayers().flatten()]
+    classes = int(next(options['classes'] for name, options in parse_cfg(config_path) if name == 'yolo'))
+    return net, output_layers, [f'class{i}' for i in range(classes)]
+
+
+def synthetic_jpeg(width, height, quality=90, seed=0):
+    # smooth gradients, a few shapes and mild sensor noise: compresses and
+    # decodes roughly like a photo, unlike pure noise or a flat image. Built
+    # in uint8 so generating it does not inflate the measured peak RSS.
+    rng = np.random.default_rng(seed)
+    corners = rng.integers(0, 256, (2, 2, 3), dtype=np.uint8)
+    image = cv2.resize(corners, (width, height), interpolation=cv2.INTER_LINEAR)
+    for _ in range(12):
+        center = (int(rng.integers(width)), int(rng.integers(height)))
+        radius = int(rng.integers(min(width, height) // 20, min(width, height) // 4))
+        cv2.circle(image, center, radius, [int(c) for c in rng.integers(0, 256, 3)], -1)
+    noise = np.empty_like(image)
+    cv2.randu(noise, 0, 8)
+    image = cv2.add(image, noise)
+    _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buffer.tobytes()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def measure(fn, iterations, warmup):
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    ms = np.array(timings) * 1000
+    return {
+        'iterations': iterations,
+        'mean_ms': float(ms.mean()),
+        'min_ms': float(ms.min()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p90_ms': float(np.percentile(ms, 90)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'max_ms': float(ms.max()),
+        'throughput_per_s': float(1000 / ms.mean()),
+        # process wide high water mark once the stage has run
+        'peak_rss_mb': round(peak_rss_mb(), 1)
+    }
+
+
+def run(args):
+    results = {}
+
+    def record(name, fn, **extra):
+        results[name] = dict(measure(fn, args.iterations, args.warmup), **extra)
+        r = results[name]
+        print(f"{name:<28} p50 {r['p50_ms']:>9.3f}  p90 {r['p90_ms']:>9.3f}  p99 {r['p99_ms']:>9.3f} ms  "
+              f"{r['throughput_per_s']:>9.1f}/s  rss {r['peak_rss_mb']:>7.1f} MB")
+
+    for resolution in args.resolutions:
+        width, height = (int(v) for v in resolution.split('x'))
+        data = synthetic_jpeg(width, height)
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        min_side = max(THUMBNAIL_SIZES + [DETECTION_SIZE])
+        reduced = decode_image(data, min_side=min_side, min_short_side=DETECTION_SIZE)
+        renditions = make_renditions(reduced)
+
+        prefix = f'{resolution}/'
+        record(prefix + 'imdecode', lambda: cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR),
+               bytes=len(data))
+        record(prefix + 'decode_reduced', lambda: decode_image(data, min_side=min_side, min_short_side=DETECTION_SIZE),
+               shape=list(reduced.shape))
+        record(prefix + 'resize_full', lambda: make_renditions(image))
+        record(prefix + 'resize_reduced', lambda: make_renditions(reduced))
+        record(prefix + 'encode_thumbnails', lambda: [encode(thumbnail) for thumbnail in renditions.values()])
+        record(prefix + 'blob_from_image', lambda: cv2.dnn.blobFromImage(
+            reduced, 1 / 255.0, (DETECTION_SIZE, DETECTION_SIZE), swapRB=True, crop=False))
+
+    # OpenCV 5 dropped the darknet importer, the Lambda layer ships 4.x
+    if not hasattr(cv2.dnn, 'readNetFromDarknet'):
+        print(f"[WARN] OpenCV {cv2.__version__} cannot read darknet models, skipping forward; "
+              "postprocess runs on synthetic layer outputs")
+        layer_outputs = make_layer_outputs(100)
+        labels = [f'class{i}' for i in range(80)]
+        record('postprocess', lambda: postprocess(layer_outputs, 1280, 960, labels), synthetic=True)
+        return results
+
+    net, output_layers, labels = load_net(args.config, args.weights)
+    # the network input is always 416x416, one forward per batch size
+    image = cv2.imdecode(np.frombuffer(synthetic_jpeg(1280, 960), np.uint8), cv2.IMREAD_COLOR)
+    for batch in args.batch_sizes:
+        blob = cv2.dnn.blobFromImages([image] * batch, 1 / 255.0, (DETECTION_SIZE, DETECTION_SIZE),
+                                      swapRB=True, crop=False)
+
+        def forward():
+            net.setInput(blob)
+            return net.forward(output_layers)
+
+        record(f'forward/batch{batch}', forward, images_per_call=batch)
+
+    net.setInput(cv2.dnn.blobFromImage(image, 1 / 255.0, (DETECTION_SIZE, DETECTION_SIZE), swapRB=True, crop=False))
+    layer_outputs = net.forward(output_layers)
+    record('postprocess', lambda: postprocess(layer_outputs, 1280, 960, labels))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    # p50 of every stage against a previous run, True when nothing regressed
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nagainst {baseline_path} (commit {baseline['meta'].get('commit')})")
+    print(f"{'stage':<28} {'base p50':>10} {'p50':>10} {'change':>8}")
+    ok = True
+    for name, result in results.items():
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['p50_ms']
+        change = result['p50_ms'] / before - 1 if before else 0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            ok = False
+        print(f"{name:<28} {before:>10.3f} {result['p50_ms']:>10.3f} {change:>+7.1%}{flag}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline CPU benchmark of the decode, thumbnail and detection stages')
+    parser.add_argument('--resolutions', nargs='+', default=RESOLUTIONS, help='source sizes as WIDTHxHEIGHT')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--threads', type=int, help='OpenCV threads, Lambda gets one vCPU per 1769 MB')
+    parser.add_argument('--config', default=CONFIG_PATH)
+    parser.add_argument('--weights', help='darknet weights, random weights of the right shape by default')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='p50 slowdown reported as a regression')
+    args = parser.parse_args()
+
+    if args.threads:
+        cv2.setNumThreads(args.threads)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if not args.weights:
+            args.weights = os.path.join(tmp, 'random.weights')
+            write_random_weights(args.config, args.weights)
+        results = run(args)
+
+    output = {
+        'meta': {
+            'commit': git_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'opencv_threads': cv2.getNumThreads(),
+            'weights': 'random' if args.weights.endswith('random.weights') else os.path.basename(args.weights),
+            'peak_rss_mb': round(peak_rss_mb(), 1)
+        },
+        'results': results
+    }
+    print(f"peak RSS {output['meta']['peak_rss_mb']} MB")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    if args.compare and not compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
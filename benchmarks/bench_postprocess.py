@@ -0,0 +1,101 @@
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda-functions'))
+
+from yolo_postprocess import confthres, decode_detections
+
+# yolov3-tiny at 416x416 has two output layers: 13x13 and 26x26 grids with
+# three anchors each and 80 COCO classes
+LAYER_ROWS = [13 * 13 * 3, 26 * 26 * 3]
+NUM_CLASSES = 80
+W, H = 1280, 960
+
+
+def make_layer_outputs(num_detections, seed=0):
+    # background rows get class scores well below the confidence threshold,
+    # then num_detections random rows are given one confident class
+    rng = np.random.default_rng(seed)
+    outputs = []
+    for rows in LAYER_ROWS:
+        output = np.zeros((rows, 5 + NUM_CLASSES), dtype=np.float32)
+        output[:, 0:4] = rng.random((rows, 4), dtype=np.float32)
+        output[:, 5:] = rng.random((rows, NUM_CLASSES), dtype=np.float32) * confthres * 0.5
+        outputs.append(output)
+
+    all_rows = np.concatenate(outputs)
+    total = len(all_rows)
+    for i in rng.choice(total, size=min(num_detections, total), replace=False):
+        layer = 0 if i < LAYER_ROWS[0] else 1
+        row = i if layer == 0 else i - LAYER_ROWS[0]
+        outputs[layer][row, 5 + rng.integers(NUM_CLASSES)] = rng.uniform(confthres + 0.01, 1.0)
+    return outputs
+
+
+def loop_decode(layerOutputs, W, H):
+    # the original per-row loop from do_prediction, kept as the reference
+    boxes = []
+    confidences = []
+    classIDs = []
+    for output in layerOutputs:
+        for detection in output:
+            scores = detection[5:]
+            classID = np.argmax(scores)
+            confidence = scores[classID]
+            if confidence > confthres:
+                box = detection[0:4] * np.array([W, H, W, H])
+                (centerX, centerY, width, height) = box.astype("int")
+                x = int(centerX - (width / 2))
+                y = int(centerY - (height / 2))
+                boxes.append([x, y, int(width), int(height)])
+                confidences.append(float(confidence))
+                classIDs.append(classID)
+    return boxes, confidences, classIDs
+
+
+def check_equivalent(layerOutputs):
+    boxes, confidences, classIDs = loop_decode(layerOutputs, W, H)
+    v_boxes, v_confidences, v_classIDs = decode_detections(layerOutputs, W, H)
+    assert len(boxes) == len(v_boxes)
+    assert list(classIDs) == v_classIDs.tolist()
+    assert np.allclose(confidences, v_confidences)
+    # the reference loop scales in float64, allow off-by-one from rounding
+    assert np.abs(np.array(boxes).reshape(-1, 4) - v_boxes).max(initial=0) <= 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark YOLO post-processing: per-row loop vs vectorized decode')
+    parser.add_argument('--detections', type=int, nargs='+', default=[0, 10, 100, 1000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=20)
+    parser.add_argument('--save', help='write the synthetic layer outputs to this .npz file')
+    parser.add_argument('--load', help='read recorded layer outputs from this .npz file instead')
+    args = parser.parse_args()
+
+    if args.load:
+        recorded = np.load(args.load)
+        cases = {}
+        for name in sorted(recorded.files):
+            count, layer = name.split('_')
+            cases.setdefault(int(count), []).append(recorded[name])
+    else:
+        cases = {n: make_layer_outputs(n) for n in args.detections}
+
+    if args.save:
+        np.savez(args.save, **{f'{n}_{i}': output for n, outputs in cases.items() for i, output in enumerate(outputs)})
+
+    print(f"{'detections':>10} {'kept':>6} {'loop ms':>10} {'vector ms':>10} {'speedup':>8}")
+    for n, layerOutputs in sorted(cases.items()):
+        check_equivalent(layerOutputs)
+        kept = len(decode_detections(layerOutputs, W, H)[0])
+        loop = min(timeit.repeat(lambda: loop_decode(layerOutputs, W, H), repeat=args.repeat, number=args.number)) / args.number
+        vector = min(timeit.repeat(lambda: decode_detections(layerOutputs, W, H), repeat=args.repeat, number=args.number)) / args.number
+        print(f"{n:>10} {kept:>6} {loop * 1000:>10.3f} {vector * 1000:>10.3f} {loop / vector:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda-functions'))
+
+from inference_profiles import PROFILES
+from yolo_model import build_model, predict
+
+IMAGE_PATTERNS = ['*.jpg', '*.jpeg', '*.png', '*.webp']
+
+# Latency against tag agreement of every inference profile on a local image
+# set. There is no ground truth: the tags of the reference profile (the
+# most accurate by default) stand in for it, so recall is "how many of the
+# objects the reference finds does this profile still find".
+
+
+def load_images(directory, limit):
+    paths = sorted(path for pattern in IMAGE_PATTERNS for path in glob.glob(os.path.join(directory, pattern)))
+    images = []
+    for path in paths[:limit]:
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+        if image is not None:
+            images.append((os.path.basename(path), image))
+    return images
+
+
+def detect(model, image):
+    # the same predict() the detection functions run
+    return predict([image], model)[0]['tags']
+
+
+def run_profile(model, images, warmup):
+    for _, image in images[:warmup]:
+        detect(model, image)
+    tags, timings = {}, []
+    for name, image in images:
+        start = time.perf_counter()
+        tags[name] = detect(model, image)
+        timings.append(time.perf_counter() - start)
+    ms = np.array(timings) * 1000
+    return tags, {
+        'images': len(images),
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p90_ms': float(np.percentile(ms, 90)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'throughput_per_s': float(1000 / ms.mean())
+    }
+
+
+def agreement(tags, reference):
+    # object level recall and precision (counting repeated tags) and the
+    # share of images with exactly the same tags as the reference
+    found = expected = predicted = exact = 0
+    for name, ref in reference.items():
+        ours, theirs = Counter(tags[name]), Counter(ref)
+        found += sum((ours & theirs).values())
+        expected += sum(theirs.values())
+        predicted += sum(ours.values())
+        exact += ours == theirs
+    return {
+        'recall': found / expected if expected else 1.0,
+        'precision': found / predicted if predicted else 1.0,
+        'exact_match': exact / len(reference) if reference else 1.0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency vs tag agreement of the inference profiles')
+    parser.add_argument('images', help='directory of test images')
+    parser.add_argument('--model-dir', default='/tmp',
+                        help='coco.names, yolov3-tiny.cfg/.weights and any ONNX exports the profiles use')
+    parser.add_argument('--profiles', nargs='+', default=list(PROFILES), choices=list(PROFILES))
+    parser.add_argument('--reference', default='accurate', choices=list(PROFILES),
+                        help='profile whose tags count as correct')
+    parser.add_argument('--limit', type=int, default=200, help='images used at most')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--threads', type=int, help='OpenCV threads, Lambda gets one vCPU per 1769 MB')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    if args.threads:
+        cv2.setNumThreads(args.threads)
+    images = load_images(args.images, args.limit)
+    if not images:
+        parser.error(f'no images in {args.images}')
+
+    profiles = list(dict.fromkeys([args.reference] + args.profiles))
+    tags, results = {}, {}
+    for name in profiles:
+        profile = PROFILES[name]
+        if args.threads:
+            profile.threads = args.threads
+        try:
+            model = build_model(profile, args.model_dir)
+        except (AttributeError, cv2.error, OSError) as e:
+            # e.g. an OpenCV build without the darknet importer, or a
+            # missing ONNX export
+            print(f"[WARN] skipping {name}: {e}")
+            continue
+        tags[name], results[name] = run_profile(model, images, args.warmup)
+        results[name]['input_size'] = profile.input_size
+        results[name]['runtime'] = type(model).__name__ + (f' ({profile.onnx_model})' if profile.onnx_model else '')
+
+    if args.reference not in tags:
+        sys.exit(f'the reference profile {args.reference} could not be loaded')
+    reference_ms = results[args.reference]['mean_ms']
+    print(f"{len(images)} images, reference {args.reference}")
+    print(f"{'profile':<10} {'input':>5} {'p50':>9} {'p90':>9} {'img/s':>7} {'speedup':>7} "
+          f"{'recall':>7} {'precision':>9} {'exact':>6}  runtime")
+    for name in profiles:
+        if name not in results:
+            continue
+        result = results[name]
+        result.update(agreement(tags[name], tags[args.reference]))
+        result['speedup'] = reference_ms / result['mean_ms']
+        print(f"{name:<10} {result['input_size']:>5} {result['p50_ms']:>7.1f}ms {result['p90_ms']:>7.1f}ms "
+              f"{result['throughput_per_s']:>7.1f} {result['speedup']:>6.2f}x {result['recall']:>7.3f} "
+              f"{result['precision']:>9.3f} {result['exact_match']:>6.3f}  {result['runtime']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'reference': args.reference, 'images': len(images), 'profiles': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+LAMBDA_DIR = os.path.join(ROOT, 'lambda-functions')
+HEAVY_MODULES = ['boto3', 'botocore', 'numpy', 'cv2']
+
+# Runs in a fresh interpreter per handler, the closest thing to a cold
+# container: import the handler, then answer a preflight and an invalid
+# request. Every AWS call fails fast against a closed local port.
+CHILD = r'''
+import contextlib, importlib.util, io, json, sys, time
+path, out = sys.argv[1], sys.argv[2]
+sys.path[:0] = [sys.argv[3], sys.argv[4]]
+result = {}
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location('handler', path)
+module = importlib.util.module_from_spec(spec)
+with contextlib.redirect_stdout(io.StringIO()):
+    spec.loader.exec_module(module)
+result['import_ms'] = (time.perf_counter() - start) * 1000
+result['loaded_after_import'] = [m for m in HEAVY if m in sys.modules]
+events = {
+    'options_ms': {'httpMethod': 'OPTIONS', 'Records': []},
+    'invalid_ms': {'httpMethod': 'POST', 'body': '{}', 'Records': []},
+}
+for name, event in events.items():
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = module.lambda_handler(event, None)
+        status = response.get('statusCode') if isinstance(response, dict) else None
+    except Exception as e:
+        status = type(e).__name__
+    result[name] = (time.perf_counter() - start) * 1000
+    result[name.replace('_ms', '_status')] = status
+result['loaded_after_calls'] = [m for m in HEAVY if m in sys.modules]
+with open(out, 'w') as f:
+    json.dump(result, f)
+'''
+
+
+def handlers():
+    paths = glob.glob(os.path.join(LAMBDA_DIR, '*.py')) + glob.glob(os.path.join(ROOT, '*.py'))
+    found = []
+    for path in sorted(paths):
+        with open(path, encoding='utf-8') as f:
+            if 'def lambda_handler' in f.read():
+                found.append(os.path.normpath(path))
+    return found
+
+
+def measure(path, runs):
+    env = dict(os.environ,
+               AWS_DEFAULT_REGION='ap-southeast-2', AWS_ACCESS_KEY_ID='startup', AWS_SECRET_ACCESS_KEY='startup',
+               AWS_ENDPOINT_URL='http://127.0.0.1:9', AWS_MAX_ATTEMPTS='1', AWS_EC2_METADATA_DISABLED='true',
+               METRICS_ENABLED='0')
+    samples = []
+    for _ in range(runs):
+        with tempfile.NamedTemporaryFile(suffix='.json') as out:
+            subprocess.run([sys.executable, '-c', f'HEAVY = {HEAVY_MODULES!r}\n' + CHILD, path, out.name,
+                            LAMBDA_DIR, ROOT], env=env, check=True, timeout=120)
+            with open(out.name) as f:
+                samples.append(json.load(f))
+    # the fastest run is the least disturbed by the machine
+    best = min(samples, key=lambda sample: sample['import_ms'])
+    for key in ('import_ms', 'options_ms', 'invalid_ms'):
+        best[key] = round(min(sample[key] for sample in samples), 2)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold import and first response time of every Lambda handler')
+    parser.add_argument('--runs', type=int, default=3, help='fresh interpreters per handler')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    parser.add_argument('handlers', nargs='*', help='handler files, all of them by default')
+    args = parser.parse_args()
+
+    report = {}
+    print(f"{'handler':<48} {'import':>9} {'options':>9} {'invalid':>9}  heavy modules after import / calls")
+    for path in args.handlers or handlers():
+        name = os.path.relpath(path, ROOT)
+        result = measure(path, args.runs)
+        report[name] = result
+        print(f"{name:<48} {result['import_ms']:>7.1f}ms {result['options_ms']:>7.1f}ms {result['invalid_ms']:>7.1f}ms  "
+              f"{','.join(result['loaded_after_import']) or '-'} / {','.join(result['loaded_after_calls']) or '-'}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
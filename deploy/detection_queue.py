@@ -0,0 +1,93 @@
+import argparse
+import json
+
+import boto3
+
+# Puts an SQS queue between the thumbnail and detection functions: creates
+# (or updates) the queue and its dead letter queue, the event source mapping
+# that feeds the detection function, and the environment both functions read.
+# Safe to run again with different settings. The functions' execution roles
+# need sqs:SendMessage (thumbnail) and sqs:ReceiveMessage, DeleteMessage,
+# GetQueueAttributes, ChangeMessageVisibility and SendMessage on the dead
+# letter queue (detection).
+
+DLQ_RETENTION_SECONDS = 14 * 24 * 3600
+
+
+def ensure_queue(sqs, name, attributes):
+    try:
+        url = sqs.get_queue_url(QueueName=name)['QueueUrl']
+    except sqs.exceptions.QueueDoesNotExist:
+        return sqs.create_queue(QueueName=name, Attributes=attributes)['QueueUrl']
+    sqs.set_queue_attributes(QueueUrl=url, Attributes=attributes)
+    return url
+
+
+def queue_arn(sqs, url):
+    return sqs.get_queue_attributes(QueueUrl=url, AttributeNames=['QueueArn'])['Attributes']['QueueArn']
+
+
+def merge_environment(lambda_client, function, variables):
+    # update_function_configuration replaces the whole environment
+    current = lambda_client.get_function_configuration(FunctionName=function)
+    environment = current.get('Environment', {}).get('Variables', {})
+    environment.update(variables)
+    lambda_client.update_function_configuration(FunctionName=function, Environment={'Variables': environment})
+    lambda_client.get_waiter('function_updated_v2').wait(FunctionName=function)
+
+
+def ensure_mapping(lambda_client, function, arn, settings):
+    existing = lambda_client.list_event_source_mappings(EventSourceArn=arn, FunctionName=function)
+    mappings = existing.get('EventSourceMappings', [])
+    if mappings:
+        return lambda_client.update_event_source_mapping(UUID=mappings[0]['UUID'], **settings)['UUID']
+    return lambda_client.create_event_source_mapping(EventSourceArn=arn, FunctionName=function, **settings)['UUID']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Feed the detection function from an SQS queue')
+    parser.add_argument('--queue', default='detection-queue')
+    parser.add_argument('--dlq', default='detection-dlq')
+    parser.add_argument('--detection-function', default='object-detection-function')
+    parser.add_argument('--thumbnail-function', default='generate-thumbnail-function')
+    parser.add_argument('--batch-size', type=int, default=10, help='records per invocation')
+    parser.add_argument('--window', type=int, default=5, help='seconds to wait filling a batch')
+    parser.add_argument('--max-concurrency', type=int, default=5,
+                        help='concurrent detection invocations the queue may start (2-1000)')
+    parser.add_argument('--max-receives', type=int, default=5, help='receives before a message is dead lettered')
+    parser.add_argument('--dry-run', action='store_true', help='print the settings without changing anything')
+    args = parser.parse_args()
+
+    lambda_client = boto3.client('lambda')
+    timeout = lambda_client.get_function_configuration(FunctionName=args.detection_function)['Timeout']
+    # AWS recommends six times the function timeout plus the batching
+    # window, so a message is not received again while a retry still runs
+    visibility = 6 * timeout + args.window
+    settings = {
+        'BatchSize': args.batch_size,
+        'MaximumBatchingWindowInSeconds': args.window,
+        'ScalingConfig': {'MaximumConcurrency': args.max_concurrency},
+        'FunctionResponseTypes': ['ReportBatchItemFailures'],
+        'Enabled': True
+    }
+    print(f"{args.queue}: visibility timeout {visibility}s, dead letter after {args.max_receives} receives")
+    print(f"{args.detection_function}: {json.dumps(settings)}")
+    if args.dry_run:
+        return
+
+    sqs = boto3.client('sqs')
+    dlq_url = ensure_queue(sqs, args.dlq, {'MessageRetentionPeriod': str(DLQ_RETENTION_SECONDS)})
+    queue_url = ensure_queue(sqs, args.queue, {
+        'VisibilityTimeout': str(visibility),
+        'RedrivePolicy': json.dumps({'deadLetterTargetArn': queue_arn(sqs, dlq_url),
+                                     'maxReceiveCount': str(args.max_receives)})
+    })
+
+    uuid = ensure_mapping(lambda_client, args.detection_function, queue_arn(sqs, queue_url), settings)
+    merge_environment(lambda_client, args.detection_function, {'DETECTION_DLQ_URL': dlq_url})
+    merge_environment(lambda_client, args.thumbnail_function, {'DETECTION_QUEUE_URL': queue_url})
+    print(f"Queue {queue_url}, dead letter queue {dlq_url}, event source mapping {uuid}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,103 @@
 import json
-import boto3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlparse
+import aws_clients
+from instrumentation import instrumented, record
+from query_cache import bump
+from tag_index import TAG_INDEX_TABLE, item_tags, normalize_tag
+from vector_feed import CHANGES_TABLE, change_item
 
-dynamodb = boto3.resource('dynamodb')
-s3 = boto3.client('s3')
-table = dynamodb.Table('database')
+dynamodb = aws_clients.resource('dynamodb')
+s3 = aws_clients.client('s3')
+table = aws_clients.table('database')
 
 THUMBNAIL_BUCKET = '5225-a3-thumbnails'
 IMAGE_BUCKET = '5225-a3-image'
 
+LOOKUP_WORKERS = 16
+BATCH_WRITE_SIZE = 25
+DELETE_OBJECTS_SIZE = 1000
+MAX_BATCH_RETRIES = 5
+# key attributes of the tables this function writes items to
+PUT_KEY_ATTRIBUTES = {CHANGES_TABLE: ('shard', 'seq')}
+
+HEADERS = {
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': '*',
+    'Access-Control-Allow-Headers': '*'
+}
+
+def find_item(thumbnail_url):
+    from boto3.dynamodb.conditions import Key
+    # Query using the GSI on thumbnail_url, through the (thread safe) client
+    response = table.meta.client.query(
+        TableName=table.name,
+        IndexName='thumbnail_url-index',
+        KeyConditionExpression=Key('thumbnail_url').eq(thumbnail_url)
+    )
+    items = response.get('Items', [])
+    return items[0] if items else None
+
+def s3_key(url):
+    return unquote(urlparse(url).path.lstrip('/'))
+
+def request_key(table_name, request):
+    # Identifies a write by the key attributes of its item. Those are strings
+    # and survive the round trip through UnprocessedItems unchanged, other
+    # attributes do not (numbers come back as Decimal).
+    if 'DeleteRequest' in request:
+        return table_name, tuple(sorted(request['DeleteRequest']['Key'].items()))
+    item = request['PutRequest']['Item']
+    return table_name, tuple(sorted((name, item[name]) for name in PUT_KEY_ATTRIBUTES[table_name]))
+
+def batch_write(requests):
+    # requests is a list of (owner, table name, write request). Returns the
+    # owners whose writes could not be applied after retrying.
+    failed = set()
+    for start in range(0, len(requests), BATCH_WRITE_SIZE):
+        chunk = requests[start:start + BATCH_WRITE_SIZE]
+        pending = {}
+        for owner, table_name, request in chunk:
+            pending.setdefault(table_name, []).append(request)
+        owners = {request_key(table_name, request): owner for owner, table_name, request in chunk}
+
+        for attempt in range(MAX_BATCH_RETRIES):
+            try:
+                response = dynamodb.batch_write_item(RequestItems=pending)
+            except Exception as e:
+                print(f"[ERROR] BatchWriteItem failed: {e}")
+                break
+            pending = response.get('UnprocessedItems') or {}
+            if not pending:
+                break
+            time.sleep(0.05 * 2 ** attempt)
+
+        for table_name, unprocessed in pending.items():
+            for request in unprocessed:
+                failed.add(owners[request_key(table_name, request)])
+    return failed
+
+def delete_objects(bucket, keys):
+    # returns {key: error message} for the objects S3 could not delete
+    errors = {}
+    for start in range(0, len(keys), DELETE_OBJECTS_SIZE):
+        chunk = keys[start:start + DELETE_OBJECTS_SIZE]
+        try:
+            response = s3.delete_objects(
+                Bucket=bucket,
+                Delete={'Objects': [{'Key': key} for key in chunk], 'Quiet': True}
+            )
+        except Exception as e:
+            errors.update({key: str(e) for key in chunk})
+            continue
+        for error in response.get('Errors', []):
+            errors[error['Key']] = error.get('Message', error.get('Code'))
+    return errors
+
+@instrumented
 def lambda_handler(event, context):
-    # Extract links from the body
-    body = json.loads(event.get('body', '{}'))
-    links = body.get('image_url')
-    
-    if not links:
-        return {
-            'statusCode': 400,
-            'body': json.dumps('No links provided'),
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': '*',
-                'Access-Control-Allow-Headers': '*'
-            },
-        }
-    
-    errors = []
-    
     # Handle CORS preflight request
     if event.get('httpMethod') == 'OPTIONS':
         return {
@@ -38,54 +109,75 @@ def lambda_handler(event, context):
             },
             'body': json.dumps('CORS preflight response')
         }
-    
-    for thumbnail_url in links:
-        try:
-            # Query DynamoDB to find the item with the provided thumbnail URL
-            response = table.scan(
-                FilterExpression=boto3.dynamodb.conditions.Attr('thumbnail_url').eq(thumbnail_url)
-            )
-            if 'Items' not in response or len(response['Items']) == 0:
-                errors.append(f'Image not found for thumbnail URL: {thumbnail_url}')
-                continue
-            
-            item = response['Items'][0]
-            image_id = item['id']
-            s3_url = item.get('s3_url')
-            
-            # Delete the item from DynamoDB
-            table.delete_item(Key={'id': image_id})
-            
-            # Extract S3 keys from URLs
-            thumbnail_key = thumbnail_url.split('/')[-1]
-            s3.delete_object(Bucket=THUMBNAIL_BUCKET, Key=thumbnail_key)
-            
-            if s3_url:
-                image_key = s3_url.split('/')[-1].replace('thumb-', '')
-                s3.delete_object(Bucket=IMAGE_BUCKET, Key=image_key)
-        
-        except Exception as e:
-            errors.append(f'Error deleting image for thumbnail URL {thumbnail_url}: {str(e)}')
-    
-    if errors:
+
+    # Extract links from the body
+    body = json.loads(event.get('body') or '{}')
+    links = body.get('image_url')
+    if isinstance(links, str):
+        links = [links]
+
+    if not links:
         return {
-            'statusCode': 207,
-            'body': json.dumps({'errors': errors}),
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': '*',
-                'Access-Control-Allow-Headers': '*'
-            },
+            'statusCode': 400,
+            'body': json.dumps('No links provided'),
+            'headers': HEADERS,
         }
-    
+
+    links = list(dict.fromkeys(links))
+    results = {url: {'url': url, 'status': 'deleted'} for url in links}
+
+    def fail(url, message):
+        results[url]['status'] = 'error'
+        results[url]['error'] = message
+
+    # Resolve every thumbnail URL through the GSI concurrently
+    items = {}
+    with ThreadPoolExecutor(max_workers=LOOKUP_WORKERS) as pool:
+        for url, future in [(url, pool.submit(find_item, url)) for url in links]:
+            try:
+                item = future.result()
+            except Exception as e:
+                fail(url, f'Error looking up thumbnail URL: {str(e)}')
+                continue
+            if item is None:
+                results[url]['status'] = 'not_found'
+                results[url]['error'] = f'Image not found for thumbnail URL: {url}'
+                continue
+            items[url] = item
+
+    # Delete the items and their tag index postings with BatchWriteItem, and
+    # drop them from the similarity index
+    requests = []
+    for url, item in items.items():
+        requests.append((url, table.name, {'DeleteRequest': {'Key': {'id': item['id']}}}))
+        requests.append((url, CHANGES_TABLE, {'PutRequest': {'Item': change_item(item['id'])}}))
+        for tag in {normalize_tag(t) for t in item_tags(item)}:
+            requests.append((url, TAG_INDEX_TABLE, {'DeleteRequest': {'Key': {'tag': tag, 'image_id': item['id']}}}))
+    for url in batch_write(requests):
+        fail(url, 'Error deleting image record from DynamoDB')
+        items.pop(url, None)
+
+    # cached searches for the tags of the deleted images are out of date now
+    bump({normalize_tag(tag) for item in items.values() for tag in item_tags(item)})
+
+    # Delete the thumbnails, their other renditions and the originals with
+    # one DeleteObjects per 1000 keys
+    objects = {THUMBNAIL_BUCKET: {}, IMAGE_BUCKET: {}}
+    for url, item in items.items():
+        objects[THUMBNAIL_BUCKET][s3_key(url)] = url
+        for key in item.get('rendition_keys', ()):
+            objects[THUMBNAIL_BUCKET][key] = url
+        if item.get('s3_url'):
+            objects[IMAGE_BUCKET][s3_key(item['s3_url'])] = url
+    for bucket, keys in objects.items():
+        for key, message in delete_objects(bucket, list(keys)).items():
+            fail(keys[key], f'Error deleting s3://{bucket}/{key}: {message}')
+
+    results = list(results.values())
+    record('deleted', sum(result['status'] == 'deleted' for result in results))
+    errors = [result['error'] for result in results if result['status'] != 'deleted']
     return {
-        'statusCode': 200,
-        'body': json.dumps('All image records and files deleted successfully'),
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': '*',
-            'Access-Control-Allow-Headers': '*'
-        },
-    }
\ No newline at end of file
+        'statusCode': 207 if errors else 200,
+        'body': json.dumps({'results': results, 'errors': errors}),
+        'headers': HEADERS,
+    }
@@ -0,0 +1,85 @@
+import os
+import threading
+
+# One tuned client (and resource) per service for the whole container,
+# built the first time a handler actually uses it. boto3 itself is only
+# imported then too, it takes a few hundred milliseconds to load.
+MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '50'))
+RETRY_MODE = os.environ.get('AWS_RETRY_MODE', 'adaptive')
+MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', '5'))
+
+# (connect, read) timeouts in seconds: DynamoDB and SNS answer in
+# milliseconds so a stuck call is retried quickly, S3 moves whole images
+TIMEOUTS = {
+    's3': (2, 30),
+    'dynamodb': (1, 5),
+    'sns': (1, 5),
+    'sqs': (1, 25),
+}
+DEFAULT_TIMEOUTS = (2, 20)
+
+_lock = threading.Lock()
+_clients = {}
+_resources = {}
+
+
+def config(service):
+    from botocore.config import Config
+    connect, read = TIMEOUTS.get(service, DEFAULT_TIMEOUTS)
+    prefix = f'AWS_{service.upper()}_'
+    return Config(
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        tcp_keepalive=True,
+        connect_timeout=float(os.environ.get(prefix + 'CONNECT_TIMEOUT', connect)),
+        read_timeout=float(os.environ.get(prefix + 'READ_TIMEOUT', read)),
+        retries={'mode': RETRY_MODE, 'max_attempts': MAX_ATTEMPTS}
+    )
+
+
+def get_client(service):
+    # creating clients is not thread safe, using them is
+    if service not in _clients:
+        with _lock:
+            if service not in _clients:
+                import boto3
+                _clients[service] = boto3.client(service, config=config(service))
+    return _clients[service]
+
+
+def get_resource(service):
+    if service not in _resources:
+        with _lock:
+            if service not in _resources:
+                import boto3
+                _resources[service] = boto3.resource(service, config=config(service))
+    return _resources[service]
+
+
+class _Lazy:
+    # stands in for a client, resource or table until it is first used
+    def __init__(self, factory):
+        self._factory = factory
+        self._target = None
+
+    def __getattr__(self, name):
+        if self._target is None:
+            self._target = self._factory()
+        return getattr(self._target, name)
+
+
+def client(service):
+    return _Lazy(lambda: get_client(service))
+
+
+def resource(service):
+    return _Lazy(lambda: get_resource(service))
+
+
+def table(name):
+    return _Lazy(lambda: get_resource('dynamodb').Table(name))
+
+
+def resource_client(service):
+    # the client behind the resource: thread safe like any client, but it
+    # still takes python types and condition objects for DynamoDB
+    return _Lazy(lambda: get_resource(service).meta.client)
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+import aws_clients
+from inference_profiles import get_profile
+
+# Detection results keyed by the SHA-256 of the image bytes: an in-container
+# LRU in front of a DynamoDB table with a TTL on 'expires_at'.
+CACHE_TABLE = os.environ.get('DETECTION_CACHE_TABLE', 'detection-cache')
+cache_table = aws_clients.table(CACHE_TABLE)
+
+MEMORY_ENTRIES = int(os.environ.get('DETECTION_CACHE_ENTRIES', '1024'))
+TTL_SECONDS = int(os.environ.get('DETECTION_CACHE_TTL', str(30 * 24 * 3600)))
+# results from a different model must never be reused, bump to invalidate
+MODEL_VERSION = os.environ.get('DETECTION_CACHE_VERSION', 'yolov3-tiny')
+# nor results of a different inference profile
+PROFILE_TAG = get_profile().cache_tag
+# near-duplicates: perceptual hashes at most this many bits apart are reused
+PHASH_ENABLED = os.environ.get('DETECTION_CACHE_PHASH', '1') == '1'
+PHASH_MAX_DISTANCE = int(os.environ.get('DETECTION_CACHE_PHASH_DISTANCE', '2'))
+# Flat images (blank, dark or one colour) have hashes of almost all zero or
+# all one bits that many unrelated images share, they are only matched
+# exactly. This many bits must be set, and this many clear.
+PHASH_MIN_BITS = int(os.environ.get('DETECTION_CACHE_PHASH_MIN_BITS', '8'))
+
+_memory = OrderedDict()  # cache key -> (result, phash)
+stats = {'memory_hits': 0, 'persistent_hits': 0, 'near_duplicate_hits': 0, 'misses': 0}
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def perceptual_hash(image):
+    # 64 bit difference hash: compare neighbouring pixels of a 9x8 grey image
+    import cv2
+    grey = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(grey, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return f'{value:016x}'
+
+
+def _distinctive(phash):
+    # whether the hash carries enough detail to be matched approximately
+    return PHASH_MIN_BITS <= bin(int(phash, 16)).count('1') <= 64 - PHASH_MIN_BITS
+
+
+def _matchable(phash):
+    if _distinctive(phash):
+        return phash
+    print(f"[INFO] perceptual hash {phash} is too flat, skipping near-duplicate matching")
+    return None
+
+
+def _key(kind, digest):
+    version = f'{MODEL_VERSION}@{PROFILE_TAG}' if PROFILE_TAG else MODEL_VERSION
+    return f'{version}#{kind}#{digest}'
+
+
+def _remember(key, result, phash=None):
+    _memory[key] = (result, phash)
+    _memory.move_to_end(key)
+    while len(_memory) > MEMORY_ENTRIES:
+        _memory.popitem(last=False)
+
+
+def _near_duplicate(phash):
+    target = int(phash, 16)
+    for key, (result, other) in reversed(_memory.items()):
+        if other is not None and bin(target ^ int(other, 16)).count('1') <= PHASH_MAX_DISTANCE:
+            return key, result
+    return None
+
+
+def _get_persistent(key):
+    item = cache_table.get_item(Key={'hash': key}).get('Item')
+    # TTL deletion is lazy, expired items can still be returned for a while
+    if not item or int(item.get('expires_at', 0)) < time.time():
+        return None
+    return json.loads(item['result'])
+
+
+def lookup(sha256, phash=None):
+    # phash is the perceptual hash, or a function computing it: that one is
+    # only called when there is no exact match, so exact hits never need
+    # the decoded image
+    key = _key('sha256', sha256)
+    if key in _memory:
+        _memory.move_to_end(key)
+        stats['memory_hits'] += 1
+        return _memory[key][0]
+
+    checked = False
+    if PHASH_ENABLED and isinstance(phash, str):
+        checked = True
+        phash = _matchable(phash)
+        match = _near_duplicate(phash) if phash else None
+        if match:
+            _memory.move_to_end(match[0])
+            stats['near_duplicate_hits'] += 1
+            return match[1]
+
+    try:
+        result = _get_persistent(key)
+        if result is None and PHASH_ENABLED and phash:
+            if callable(phash):
+                phash = _matchable(phash())
+            if phash and not checked:
+                match = _near_duplicate(phash)
+                if match:
+                    _memory.move_to_end(match[0])
+                    stats['near_duplicate_hits'] += 1
+                    return match[1]
+            if phash:
+                result = _get_persistent(_key('phash', phash))
+    except (BotoCoreError, ClientError) as e:
+        # the cache must never fail a detection
+        print(f"[WARN] detection cache lookup failed: {e}")
+        result = None
+
+    if result is None:
+        stats['misses'] += 1
+        return None
+    stats['persistent_hits'] += 1
+    _remember(key, result, phash if isinstance(phash, str) else None)
+    return result
+
+
+def store(sha256, result, phash=None):
+    # already reported by the lookup that missed
+    if phash and not _distinctive(phash):
+        phash = None
+    key = _key('sha256', sha256)
+    _remember(key, result, phash)
+    expires_at = int(time.time()) + TTL_SECONDS
+    keys = [key] + ([_key('phash', phash)] if PHASH_ENABLED and phash else [])
+    try:
+        with cache_table.batch_writer() as batch:
+            for item_key in keys:
+                batch.put_item(Item={'hash': item_key, 'result': json.dumps(result), 'expires_at': expires_at})
+    except (BotoCoreError, ClientError) as e:
+        print(f"[WARN] detection cache store failed: {e}")
+
+
+def log_stats():
+    hits = stats['memory_hits'] + stats['persistent_hits'] + stats['near_duplicate_hits']
+    total = hits + stats['misses']
+    print("[INFO] detection cache: {} hits ({} memory, {} near duplicate, {} persistent), {} misses, "
+          "hit rate {:.1%}".format(hits, stats['memory_hits'], stats['near_duplicate_hits'],
+                                   stats['persistent_hits'], stats['misses'], hits / total if total else 0))
@@ -1,52 +1,114 @@
-import boto3
+import aws_clients
 import json
-import cv2
-import numpy as np
+import os
 from botocore.exceptions import ClientError
-from io import BytesIO
 from urllib.parse import unquote_plus
+from detection_cache import content_hash, perceptual_hash
+from http_cache import IMMUTABLE
+from instrumentation import instrumented, record_size, stage
+from thumbnails import (DETECTION_SIZE, THUMBNAIL_SIZES, decode_image, encode, encode_detection_input,
+                        make_renditions, output_formats, rendition_settings)
 
-s3_client = boto3.client('s3')
+s3_client = aws_clients.client('s3')
 # Define SNS client and the topic ARN
-sns_client = boto3.client('sns')
+sns_client = aws_clients.client('sns')
 TOPIC_ARN = 'arn:aws:sns:us-east-1:534701713148:ForLambdaTopic'
+# When set, detection requests go to this SQS queue instead of the topic so
+# the detection function consumes them in batches at a capped concurrency
+DETECTION_QUEUE_URL = os.environ.get('DETECTION_QUEUE_URL')
+sqs_client = aws_clients.client('sqs')
 
+THUMBNAIL_BUCKET = 'tianfu-thumbnail-bucket'
+CONTENT_TYPES = {'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+
+def rendition_digest(source_sha256):
+    # Depends on the source bytes and everything that changes the encoded
+    # output, so what is stored under a key never changes and browsers and
+    # CDNs can keep it for good
+    return content_hash(f'{source_sha256}:{rendition_settings()}'.encode())[:16]
+
+def thumbnail_key(key, size, fmt, digest):
+    # the primary JPEG is "thumb-<digest>-<key>", the other renditions carry
+    # their size in the name too
+    name = f"thumb-{digest}-{key}" if size == THUMBNAIL_SIZES[0] else f"thumb-{size}-{digest}-{key}"
+    return name + '.webp' if fmt == 'webp' else name
+
+@instrumented
 def lambda_handler(event, context):
     for record in event['Records']:
         bucket = record['s3']['bucket']['name']
         key = unquote_plus(record['s3']['object']['key'])
 
         try:
-            response = s3_client.get_object(Bucket=bucket, Key=key)
-            img_data = response['Body'].read()
-            
-            # Convert image to numpy array and read with OpenCV
-            np_array = np.fromstring(img_data, np.uint8)
-            image = cv2.imdecode(np_array, cv2.IMREAD_COLOR)
-            
-            # Generate thumbnail
-            thumbnail = cv2.resize(image, (128, 128), interpolation=cv2.INTER_AREA)
-            
-            # Convert thumbnail to bytes using imencode (already done in your code)
-            _, buffer = cv2.imencode('.jpg', thumbnail)
-            thumbnail_bytes = BytesIO(buffer)
-
-            # Upload the thumbnail_bytes (which is already image data) to S3 using put_object
-            thumbnail_bucket = 'tianfu-thumbnail-bucket'
-            thumbnail_key = "thumb-" + key  # You can keep the same key name here
-            s3_client.put_object(Bucket=thumbnail_bucket, Key=thumbnail_key, Body=thumbnail_bytes.getvalue())
-            
-            # Publish message to SNS
-            message = json.dumps({'object_key': key})
-            sns_client.publish(TopicArn=TOPIC_ARN, Message=message)
-        
-        except ClientError as e:
+            with stage('s3_get'):
+                response = s3_client.get_object(Bucket=bucket, Key=key)
+                img_data = response['Body'].read()
+            record_size('image', len(img_data))
+            with stage('hash'):
+                source_sha256 = content_hash(img_data)
+            digest = rendition_digest(source_sha256)
+
+            # Decode once, reduced while decoding when the source is much
+            # larger than the biggest rendition and the detector input
+            with stage('decode'):
+                image = decode_image(img_data, min_side=max(THUMBNAIL_SIZES + [DETECTION_SIZE]),
+                                     min_short_side=DETECTION_SIZE)
+            if image is None:
+                raise ValueError(f'Failed to decode image {key}')
+
+            # Generate every aspect preserving rendition and upload it
+            with stage('resize'):
+                renditions = make_renditions(image)
+            rendition_keys = []
+            for size, thumbnail in renditions.items():
+                for fmt in output_formats():
+                    with stage('encode'):
+                        body = encode(thumbnail, fmt)
+                    record_size('thumbnail', len(body))
+                    rendition_keys.append(thumbnail_key(key, size, fmt, digest))
+                    with stage('s3_put'):
+                        s3_client.put_object(
+                            Bucket=THUMBNAIL_BUCKET,
+                            Key=rendition_keys[-1],
+                            Body=body,
+                            ContentType=CONTENT_TYPES[fmt],
+                            CacheControl=IMMUTABLE
+                        )
+
+            # Request detection. The detector input rides along so the
+            # detection function needs neither the S3 GET nor a full decode.
+            # The hashes let detection reuse the result of an identical or
+            # near identical upload. Every rendition key is stored on the
+            # item so deleting the image deletes all of them.
+            primary_key = thumbnail_key(key, THUMBNAIL_SIZES[0], 'jpeg', digest)
+            with stage('phash'):
+                message = {
+                    'object_key': key,
+                    'thumbnail_key': primary_key,
+                    'rendition_keys': [name for name in rendition_keys if name != primary_key],
+                    'content_sha256': source_sha256,
+                    'phash': perceptual_hash(image)
+                }
+            with stage('detection_input'):
+                detection_input = encode_detection_input(image)
+            if detection_input:
+                message['detection_input'] = detection_input
+            message = json.dumps(message)
+            record_size('message', len(message))
+            if DETECTION_QUEUE_URL:
+                with stage('sqs_send'):
+                    sqs_client.send_message(QueueUrl=DETECTION_QUEUE_URL, MessageBody=message)
+            else:
+                with stage('sns_publish'):
+                    sns_client.publish(TopicArn=TOPIC_ARN, Message=message)
+
+        except (ClientError, ValueError) as e:
             print(e)
             return {
                 'statusCode': 400,
                 'body': json.dumps('Error processing image')
             }
-        
+
     return {
             'statusCode': 200,
             'body': json.dumps('Thumbnail generated successfully')
@@ -0,0 +1,45 @@
+import hashlib
+
+# Conditional responses for API Gateway proxy handlers: the ETag is a hash
+# of the response body, a request whose If-None-Match already names it gets
+# an empty 304 so the browser (or a CDN) reuses what it has.
+NO_CACHE = 'no-cache'  # may be stored, but revalidated every time
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# If-None-Match only makes a 304 of safe requests, anything else must run
+CONDITIONAL_METHODS = {'GET', 'HEAD'}
+
+
+def etag(body):
+    return '"' + hashlib.sha256(body.encode()).hexdigest()[:32] + '"'
+
+
+def header(event, name):
+    # API Gateway keeps the case the client sent
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def matches(if_none_match, tag):
+    if not if_none_match:
+        return False
+    candidates = {value.strip().removeprefix('W/') for value in if_none_match.split(',')}
+    return '*' in candidates or tag in candidates
+
+
+def conditional(event, response, cache_control=NO_CACHE):
+    # Adds ETag and Cache-Control to a 200 response to a GET, or turns it into
+    # a 304 when the client already holds the same body
+    if response.get('statusCode') != 200 or event.get('httpMethod') not in CONDITIONAL_METHODS:
+        return response
+    tag = etag(response.get('body') or '')
+    headers = dict(response.get('headers') or {})
+    headers['ETag'] = tag
+    headers['Cache-Control'] = cache_control
+    # lets the page read the ETag of a cross origin response
+    headers['Access-Control-Expose-Headers'] = 'ETag'
+    if matches(header(event, 'If-None-Match'), tag):
+        return {'statusCode': 304, 'headers': headers, 'body': ''}
+    return dict(response, headers=headers)
@@ -0,0 +1,46 @@
+import os
+
+# Named trade-offs between detection cost and recall, chosen per function
+# with INFERENCE_PROFILE. The bulk ingest path can run "fast" while
+# query-by-image stays on "balanced" or "accurate".
+DEFAULT_PROFILE = 'balanced'
+# OpenCV / onnxruntime threads, Lambda gets one vCPU per 1769 MB
+THREADS = int(os.environ['INFERENCE_THREADS']) if os.environ.get('INFERENCE_THREADS') else None
+
+
+class InferenceProfile:
+    def __init__(self, name, input_size, onnx_model=None, thresholds=None):
+        self.name = name
+        # square network input, a multiple of 32
+        self.input_size = input_size
+        # ONNX export of the model (in the detection bucket) run through
+        # onnxruntime when it is installed, cv2.dnn otherwise. None runs the
+        # darknet yolov3-tiny files.
+        self.onnx_model = onnx_model
+        # overrides of the yolo_postprocess confthres, nmsthres and tagthres
+        self.thresholds = thresholds or {}
+        self.threads = THREADS
+
+    @property
+    def cache_tag(self):
+        # what makes results of this profile differ from the others, part of
+        # the detection cache key. Empty for "balanced", so it keeps using the
+        # entries written before profiles existed.
+        if self.name == DEFAULT_PROFILE and not self.onnx_model and not self.thresholds:
+            return ''
+        return f'{self.name}-{self.input_size}' + (f'-{self.onnx_model}' if self.onnx_model else '')
+
+
+PROFILES = {
+    # FAST_PROFILE_MODEL names an ONNX export, e.g. an int8 quantized one
+    'fast': InferenceProfile('fast', 320, onnx_model=os.environ.get('FAST_PROFILE_MODEL') or None),
+    'balanced': InferenceProfile('balanced', 416),
+    'accurate': InferenceProfile('accurate', 608),
+}
+
+
+def get_profile(name=None):
+    name = name or os.environ.get('INFERENCE_PROFILE', DEFAULT_PROFILE)
+    if name not in PROFILES:
+        raise ValueError(f"Unknown inference profile {name!r}, expected one of {', '.join(PROFILES)}")
+    return PROFILES[name]
@@ -0,0 +1,110 @@
+import functools
+import json
+import os
+import time
+from contextlib import contextmanager
+
+# Metrics are printed as CloudWatch Embedded Metric Format lines: CloudWatch
+# turns them into metrics (with percentiles) without any API call, and
+# Logs Insights can still query every field of the line.
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', '5225-a3')
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+# strings longer than this are cut when an event is logged
+MAX_LOGGED_CHARS = int(os.environ.get('MAX_LOGGED_CHARS', '256'))
+FUNCTION_NAME = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+EMF_MAX_VALUES = 100  # values per metric in one EMF line
+
+_cold_start = True
+_values = {}  # metric name -> (unit, [values]) of the current invocation
+
+
+def record(name, value, unit='Count'):
+    _values.setdefault(name, (unit, []))[1].append(value)
+
+
+def record_size(name, size):
+    record(name + '_bytes', size, 'Bytes')
+
+
+@contextmanager
+def stage(name):
+    # with stage('s3_get'): ... records s3_get_ms, once per pass
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name + '_ms', round((time.perf_counter() - start) * 1000, 3), 'Milliseconds')
+
+
+def emit(**properties):
+    if not METRICS_ENABLED or not _values:
+        _values.clear()
+        return
+    line = {'function': FUNCTION_NAME}
+    line.update(properties)
+    metrics = []
+    for name, (unit, values) in _values.items():
+        metrics.append({'Name': name, 'Unit': unit})
+        line[name] = values[0] if len(values) == 1 else values[:EMF_MAX_VALUES]
+    line['_aws'] = {
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{'Namespace': NAMESPACE, 'Dimensions': [['function']], 'Metrics': metrics}]
+    }
+    print(json.dumps(line, default=str))
+    _values.clear()
+
+
+def redact(value, limit=None):
+    # a copy that is safe to log: long strings (base64 images, presigned
+    # URLs) are cut down to their start and length, JSON bodies are
+    # redacted field by field
+    limit = limit or MAX_LOGGED_CHARS
+    if isinstance(value, dict):
+        return {key: redact(item, limit) for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact(item, limit) for item in value[:20]] + ([f'<{len(value) - 20} more>'] if len(value) > 20 else [])
+    if isinstance(value, str) and len(value) > limit:
+        if value[:1] in '{[':
+            try:
+                return redact(json.loads(value), limit)
+            except ValueError:
+                pass
+        return f'{value[:32]}...<{len(value)} chars>'
+    return value
+
+
+def log_event(event, label='Received event'):
+    print(f"{label}: {json.dumps(redact(event), default=str)}")
+
+
+def _body_size(message):
+    body = message.get('body') if isinstance(message, dict) else None
+    return len(body) if isinstance(body, str) else None
+
+
+def instrumented(handler):
+    # Wraps a lambda_handler: records cold start, duration and the request
+    # and response body sizes next to whatever stages the handler records,
+    # then emits one EMF line per invocation.
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global _cold_start
+        cold, _cold_start = _cold_start, False
+        _values.clear()
+        record('cold_start', int(cold))
+        request_size = _body_size(event)
+        if request_size is not None:
+            record_size('request', request_size)
+        start = time.perf_counter()
+        response = None
+        try:
+            response = handler(event, context)
+            return response
+        finally:
+            record('duration_ms', round((time.perf_counter() - start) * 1000, 3), 'Milliseconds')
+            response_size = _body_size(response)
+            if response_size is not None:
+                record_size('response', response_size)
+            emit(request_id=getattr(context, 'aws_request_id', None),
+                 status_code=response.get('statusCode') if isinstance(response, dict) else None)
+    return wrapper
@@ -0,0 +1,179 @@
+import json
+import os
+import time
+import uuid
+
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+import aws_clients
+from instrumentation import instrumented, record
+from pagination import iter_items
+from subscriber_matcher import find_subscribers, notify_subscribers, publish
+
+# Matches waiting to be sent, partition key 'user_email', sort key 'match_id'.
+# Besides the 'm#...' match items every user with something pending has a
+# '#pending' header item that counts them and says when the digest is due.
+# The header is in the sparse GSI 'due-index' (is_pending + flush_after)
+# only while matches are waiting, so the flush never scans.
+BUFFER_TABLE = 'notification-buffer'
+buffer_table = aws_clients.table(BUFFER_TABLE)
+HEADER_ID = '#pending'
+
+# 'digest' buffers matches per user, 'immediate' publishes one per image
+NOTIFICATION_MODE = os.environ.get('NOTIFICATION_MODE', 'digest')
+DIGEST_WINDOW_SECONDS = int(os.environ.get('DIGEST_WINDOW_SECONDS', '900'))
+DIGEST_MAX_MATCHES = int(os.environ.get('DIGEST_MAX_MATCHES', '25'))
+DIGEST_MAX_LISTED = 50
+# Only the holder of the lease on a user's header sends that user's digest,
+# so concurrent detections crossing the threshold send it once. Expires in
+# case the holder dies before releasing it.
+FLUSH_LEASE_SECONDS = 120
+
+
+def route_matches(tags, thumbnail_url):
+    if NOTIFICATION_MODE != 'digest':
+        return notify_subscribers(tags, thumbnail_url)
+    matches = find_subscribers(tags)
+    if matches:
+        buffer_matches(matches, thumbnail_url)
+    return len(matches)
+
+
+def buffer_matches(matches, thumbnail_url):
+    now = int(time.time())
+    full = []
+    for user_email, tags in matches.items():
+        buffer_table.put_item(Item={
+            'user_email': user_email,
+            'match_id': f'm#{int(time.time() * 1000):013d}#{uuid.uuid4().hex[:8]}',
+            'thumbnail_url': thumbnail_url,
+            'tags': sorted(tags)
+        })
+        # opens the window on the first match, only counts the later ones
+        header = buffer_table.update_item(
+            Key={'user_email': user_email, 'match_id': HEADER_ID},
+            UpdateExpression='ADD #count :one SET #pending = :y, #due = if_not_exists(#due, :due)',
+            ExpressionAttributeNames={'#count': 'pending_count', '#pending': 'is_pending', '#due': 'flush_after'},
+            ExpressionAttributeValues={':one': 1, ':y': 'Y', ':due': now + DIGEST_WINDOW_SECONDS},
+            ReturnValues='UPDATED_NEW'
+        )
+        if header['Attributes']['pending_count'] >= DIGEST_MAX_MATCHES:
+            full.append(user_email)
+
+    # a user who hit the count threshold gets the digest right away
+    if full:
+        flush_users(full)
+
+
+def build_digest(user_email, items):
+    tags = sorted({tag for item in items for tag in item['tags']})
+    lines = [f"- {item['thumbnail_url']} ({', '.join(item['tags'])})" for item in items[:DIGEST_MAX_LISTED]]
+    if len(items) > DIGEST_MAX_LISTED:
+        lines.append(f"... and {len(items) - DIGEST_MAX_LISTED} more")
+    return {
+        'Subject': f"{len(items)} new image(s) matching your tags",
+        'Message': f"New images tagged {', '.join(tags)} were uploaded:\n" + "\n".join(lines),
+        'MessageAttributes': {'user_email': {'DataType': 'String', 'StringValue': user_email}}
+    }
+
+
+def _lease(user_email):
+    now = int(time.time())
+    try:
+        buffer_table.update_item(
+            Key={'user_email': user_email, 'match_id': HEADER_ID},
+            UpdateExpression='SET #lease = :until',
+            ConditionExpression='attribute_exists(user_email) AND (attribute_not_exists(#lease) OR #lease < :now)',
+            ExpressionAttributeNames={'#lease': 'flush_lease'},
+            ExpressionAttributeValues={':until': now + FLUSH_LEASE_SECONDS, ':now': now}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return False
+    return True
+
+
+def _release(user_email):
+    buffer_table.update_item(
+        Key={'user_email': user_email, 'match_id': HEADER_ID},
+        UpdateExpression='REMOVE #lease',
+        ExpressionAttributeNames={'#lease': 'flush_lease'}
+    )
+
+
+def _settle(user_email, flushed):
+    # flushed is the number of match items the lease holder deleted, each of
+    # them was counted exactly once by buffer_matches
+    key = {'user_email': user_email, 'match_id': HEADER_ID}
+    buffer_table.update_item(
+        Key=key,
+        UpdateExpression='ADD #count :flushed REMOVE #lease',
+        ExpressionAttributeNames={'#count': 'pending_count', '#lease': 'flush_lease'},
+        ExpressionAttributeValues={':flushed': -flushed}
+    )
+    # Close the window unless matches arrived while flushing, those keep the
+    # header in the due index and go out with the next flush.
+    try:
+        buffer_table.update_item(
+            Key=key,
+            UpdateExpression='REMOVE #pending, #due',
+            ConditionExpression='#count <= :zero',
+            ExpressionAttributeNames={'#count': 'pending_count', '#pending': 'is_pending', '#due': 'flush_after'},
+            ExpressionAttributeValues={':zero': 0}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+
+def flush_users(user_emails):
+    pending = []
+    for user_email in user_emails:
+        # another flush of this user is in progress, it sends what is here
+        if not _lease(user_email):
+            continue
+        items = list(iter_items(
+            buffer_table.query,
+            KeyConditionExpression=Key('user_email').eq(user_email) & Key('match_id').begins_with('m#')
+        ))
+        if items:
+            pending.append((user_email, items))
+        else:
+            _settle(user_email, 0)
+    if not pending:
+        return 0
+
+    # Publish first and delete after: a crash in between sends a digest
+    # twice rather than losing it. Digests SNS did not accept stay buffered
+    # and due, the next run sends them again.
+    failed = publish([build_digest(user_email, items) for user_email, items in pending])
+    for i, (user_email, items) in enumerate(pending):
+        if i in failed:
+            _release(user_email)
+            continue
+        with buffer_table.batch_writer() as batch:
+            for item in items:
+                batch.delete_item(Key={'user_email': user_email, 'match_id': item['match_id']})
+        _settle(user_email, len(items))
+    return len(pending) - len(failed)
+
+
+@instrumented
+def lambda_handler(event, context):
+    # Runs on a schedule (e.g. every minute) and sends every digest whose
+    # window has closed.
+    due = iter_items(
+        buffer_table.query,
+        IndexName='due-index',
+        KeyConditionExpression=Key('is_pending').eq('Y') & Key('flush_after').lte(int(time.time()))
+    )
+    user_emails = list(dict.fromkeys(item['user_email'] for item in due))
+    sent = flush_users(user_emails)
+    record('digests_sent', sent)
+    print(f"[INFO] Sent {sent} digest(s) for {len(user_emails)} due user(s)")
+    return {
+        'statusCode': 200,
+        'body': json.dumps({'digests_sent': sent})
+    }
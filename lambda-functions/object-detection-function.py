@@ -1,166 +1,373 @@
-import boto3
+import aws_clients
 import json
-import cv2
-import numpy as np
-import uuid
+import os
 import time
+import uuid
+from collections import Counter
+from urllib.parse import urlparse
+from tag_index import add_postings, item_tags, normalize_tag, remove_postings
+from notification_digest import route_matches
+from vector_feed import record_change
+from query_cache import bump
+from detection_cache import content_hash, log_stats, lookup, store
+from inference_profiles import get_profile
+from instrumentation import instrumented, record, record_size, stage
 
-s3_client = boto3.client('s3')
-dynamodb = boto3.client('dynamodb')
+s3_client = aws_clients.client('s3')
+dynamodb = aws_clients.client('dynamodb')
+sqs_client = aws_clients.client('sqs')
 
 TABLE_NAME = 'database'
-DETECTION_BUCKET = '5225-a3-detection-files'
-YOLO_FILES = ['coco.names', 'yolov3-tiny.cfg', 'yolov3-tiny.weights']
-
-# construct the argument parse and parse the arguments
-confthres = 0.3
-nmsthres = 0.1
-
-def load_model(configpath, weightspath):
-    # load our YOLO object detector trained on COCO dataset (80 classes)
-    print("[INFO] loading YOLO from disk...")
-    net = cv2.dnn.readNetFromDarknet(configpath, weightspath)
-    return net
-
-
-def do_prediction(image, net, LABELS):
-    (H, W) = image.shape[:2]
-    # determine only the *output* layer names that we need from YOLO
-    ln = net.getLayerNames()
-    ln = [ln[i - 1] for i in net.getUnconnectedOutLayers()]
-
-    # construct a blob from the input image and then perform a forward
-    # pass of the YOLO object detector, giving us our bounding boxes and
-    # associated probabilities
-    blob = cv2.dnn.blobFromImage(image, 1 / 255.0, (416, 416), swapRB=True, crop=False)
-    net.setInput(blob)
-    start = time.time()
-    layerOutputs = net.forward(ln)
-    # print(layerOutputs)
-    end = time.time()
-
-    # show timing information on YOLO
-    print("[INFO] YOLO took {:.6f} seconds".format(end - start))
-
-    # initialize our lists of detected bounding boxes, confidences, and
-    # class IDs, respectively
-    boxes = []
-    confidences = []
-    classIDs = []
-
-    # loop over each of the layer outputs
-    for output in layerOutputs:
-        # loop over each of the detections
-        for detection in output:
-            # extract the class ID and confidence (i.e., probability) of
-            # the current object detection
-            scores = detection[5:]
-            # print(scores)
-            classID = np.argmax(scores)
-            # print(classID)
-            confidence = scores[classID]
-
-            # filter out weak predictions by ensuring the detected
-            # probability is greater than the minimum probability
-            if confidence > confthres:
-                # scale the bounding box coordinates back relative to the
-                # size of the image, keeping in mind that YOLO actually
-                # returns the center (x, y)-coordinates of the bounding
-                # box followed by the boxes' width and height
-                box = detection[0:4] * np.array([W, H, W, H])
-                (centerX, centerY, width, height) = box.astype("int")
-
-                # use the center (x, y)-coordinates to derive the top and
-                # and left corner of the bounding box
-                x = int(centerX - (width / 2))
-                y = int(centerY - (height / 2))
-
-                # update our list of bounding box coordinates, confidences,
-                # and class IDs
-                boxes.append([x, y, int(width), int(height)])
-
-                confidences.append(float(confidence))
-                classIDs.append(classID)
-
-    # apply non-maxima suppression to suppress weak, overlapping bounding boxes
-    idxs = cv2.dnn.NMSBoxes(boxes, confidences, confthres, nmsthres)
-
-    results = {"tags": []}
-    # TODO Prepare the output as required to the assignment specification
-    # ensure at least one detection exists
-    if len(idxs) > 0:
-        # loop over the indexes we are keeping
-        for i in idxs.flatten():
-            # ignore detected objects with an accuracy of detection below 0.5
-            if(confidences[i] < 0.5):
-                continue
-            results["tags"].append(LABELS[classIDs[i]])
-            
-    return results
+IMAGE_BUCKET = '5225-a3-image'
+THUMBNAIL_BUCKET = '5225-a3-thumbnails'
 
-def download_yolo_files():
-    for file_name in YOLO_FILES:
-        s3_client.download_file(DETECTION_BUCKET, file_name, f'/tmp/{file_name}')
+# number of images stacked into a single forward pass
+BATCH_SIZE = int(os.environ.get('DETECTION_BATCH_SIZE', '8'))
+# INFERENCE_PROFILE, see inference_profiles
+PROFILE = get_profile()
+
+# Fed from the detection queue: records not started this long before the
+# function times out are handed back to the queue instead of being cut off
+TIME_MARGIN_MS = int(os.environ.get('DETECTION_TIME_MARGIN_MS', '5000'))
+# failed records are received again after RETRY_BASE_SECONDS, doubled on
+# every receive, so a throttled DynamoDB gets room to recover
+RETRY_BASE_SECONDS = int(os.environ.get('DETECTION_RETRY_BASE_SECONDS', '10'))
+MAX_RETRY_SECONDS = 900
+# messages that can never succeed go here directly, the redrive policy of
+# the queue catches everything else after maxReceiveCount receives
+DLQ_URL = os.environ.get('DETECTION_DLQ_URL')
+
+# OpenCV, NumPy and the model are imported by the functions that use them:
+# a batch answered entirely from the detection cache never loads them.
+
+
+def record_id(record):
+    if 'Sns' in record:
+        return record['Sns'].get('MessageId')
+    return record.get('messageId')
+
+
+def parse_message(record):
+    # SNS delivers the message inline, SQS wraps it in the body (which is an
+    # SNS envelope itself unless raw message delivery is enabled)
+    if 'Sns' in record:
+        return json.loads(record['Sns']['Message'])
+    message = json.loads(record['body'])
+    if 'Message' in message and 'object_key' not in message:
+        message = json.loads(message['Message'])
+    return message
+
+
+def load_image(message):
+    # the thumbnail stage normally passes the pre-resized detector input,
+    # fall back to fetching and decoding the original
+    import cv2
+    import numpy as np
+    from thumbnails import DETECTION_SIZE, decode_detection_input
+    # a profile with a larger input than the pre-resized one needs the original
+    if message.get('detection_input') and PROFILE.input_size <= DETECTION_SIZE:
+        with stage('decode'):
+            image = decode_detection_input(message['detection_input'])
+        if image is not None:
+            return image
+
+    object_key = message['object_key']
+    with stage('s3_get'):
+        img_response = s3_client.get_object(Bucket=IMAGE_BUCKET, Key=object_key)
+        img_data = img_response['Body'].read()
+    record_size('image', len(img_data))
+    message['content_sha256'] = content_hash(img_data)
+    with stage('decode'):
+        np_array = np.frombuffer(img_data, np.uint8)
+        image = cv2.imdecode(np_array, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f'Failed to decode image {object_key}')
+    return image
 
-def lambda_handler(event, context):
 
+def thumbnail_keys(item):
+    # every thumbnail object of a low level item: the primary and the other
+    # renditions
+    keys = {urlparse(item['thumbnail_url']['S']).path.lstrip('/')} if 'thumbnail_url' in item else set()
+    return keys | set(item.get('rendition_keys', {}).get('SS', []))
+
+
+def replace_previous(id, old, item):
+    # Uploading to the same key again overwrites the item: drop the postings
+    # of tags the new image does not have and the thumbnails it does not use
+    # anymore. Returns the dropped tags. The new image is stored already, a
+    # failure here is only logged.
+    tags = old.get('tags', {})
+    old_tags = {normalize_tag(tag) for tag in (tags['SS'] if 'SS' in tags else item_tags({'tags': tags.get('S')}))}
+    dropped = old_tags - set(item.get('tags', {}).get('SS', []))
     try:
-        download_yolo_files()
-
-        ## Yolov3-tiny versrion
-        labelsPath = "/tmp/coco.names"
-        Lables = open(labelsPath).read().strip().split("\n")
-        CFG = "/tmp/yolov3-tiny.cfg"
-        Weights = "/tmp/yolov3-tiny.weights"
-        # load the neural net.
-        nets = load_model(CFG, Weights)
+        if dropped:
+            remove_postings(id, dropped)
+        stale = thumbnail_keys(old) - thumbnail_keys(item)
+        if stale:
+            s3_client.delete_objects(Bucket=THUMBNAIL_BUCKET,
+                                     Delete={'Objects': [{'Key': key} for key in sorted(stale)], 'Quiet': True})
     except Exception as e:
-        print("Fail to load yolo_tiny_configs......")
-        print(f"Error: {str(e)}")
-        return {
-            'statusCode': 400,
-            'body': json.dumps('Error loading yolo_tiny_configs')
+        print(f"[WARN] Could not clean up the previous version of {id}: {e}")
+    return dropped
+
+
+def store_result(object_key, tags, thumbnail_key=None, rendition_keys=None):
+    thumbnail_key = thumbnail_key or "thumb-" + object_key
+
+    # The ID is derived from the object key: a record that is retried or
+    # delivered twice overwrites its own item and postings instead of
+    # storing the image again
+    id = str(uuid.uuid5(uuid.NAMESPACE_URL, f's3://{IMAGE_BUCKET}/{object_key}'))
+
+    # Store metadata in DynamoDB. Tags are a native string set so they can be
+    # edited atomically with ADD/DELETE, the per label object counts of the
+    # detection are kept next to them.
+    counts = Counter(normalize_tag(tag) for tag in tags['tags'])
+    item = {
+        'id': {'S': id},
+        's3_url': {'S': f'https://{IMAGE_BUCKET}.s3.ap-southeast-2.amazonaws.com/{object_key}'},
+        'thumbnail_url': {'S': f'https://{THUMBNAIL_BUCKET}.s3.ap-southeast-2.amazonaws.com/{thumbnail_key}'},
+        'tag_counts': {'M': {tag: {'N': str(count)} for tag, count in counts.items()}},
+        'inference_profile': {'S': PROFILE.name}
+    }
+    # DynamoDB does not allow empty sets
+    if counts:
+        item['tags'] = {'SS': sorted(counts)}
+    # the other thumbnail renditions, deleted together with the primary one
+    if rendition_keys:
+        item['rendition_keys'] = {'SS': sorted(set(rendition_keys))}
+
+    with stage('dynamodb_write'):
+        old = dynamodb.put_item(TableName=TABLE_NAME, Item=item, ReturnValues='ALL_OLD').get('Attributes', {})
+        add_postings(id, tags['tags'], item['thumbnail_url']['S'])
+        dropped = replace_previous(id, old, item) if old else set()
+        record_change(id, item['thumbnail_url']['S'], counts)
+        # cached searches for any of these tags, or the ones the image
+        # lost, are out of date now
+        bump(set(counts) | dropped)
+    print(f"[INFO] Stored {object_key} as {id} with tags {sorted(counts)}")
+
+    # Tell the users subscribed to any of the detected tags, coalesced into
+    # digests. The image is already stored, a failed notification must not
+    # fail the record.
+    try:
+        with stage('notify'):
+            notified = route_matches(tags['tags'], item['thumbnail_url']['S'])
+        print(f"[INFO] Matched {notified} subscriber(s) for {object_key}")
+    except Exception as e:
+        print(f"[WARN] Failed to notify subscribers of {object_key}: {e}")
+
+
+def queue_url(arn):
+    # arn:aws:sqs:<region>:<account>:<name>
+    _, _, _, region, account, name = arn.split(':')
+    return f'https://sqs.{region}.amazonaws.com/{account}/{name}'
+
+
+def receive_count(queue_record):
+    return int(queue_record.get('attributes', {}).get('ApproximateReceiveCount', '1'))
+
+
+def is_permanent(e):
+    # errors retrying cannot fix: a malformed message, an image that does
+    # not decode or no longer exists
+    if isinstance(e, (ValueError, KeyError)):
+        return True
+    return getattr(e, 'response', {}).get('Error', {}).get('Code') == 'NoSuchKey'
+
+
+def out_of_time(context, reserve_ms):
+    # context is None when the handler is called locally
+    if context is None:
+        return False
+    return context.get_remaining_time_in_millis() < TIME_MARGIN_MS + reserve_ms
+
+
+def dead_letter(queue_record, error):
+    # Poison messages go straight to the dead letter queue instead of being
+    # received again until the redrive policy gives up on them
+    sqs_client.send_message(
+        QueueUrl=DLQ_URL,
+        MessageBody=queue_record['body'],
+        MessageAttributes={
+            'error': {'DataType': 'String', 'StringValue': str(error)[:256] or type(error).__name__},
+            'source_queue': {'DataType': 'String', 'StringValue': queue_record['eventSourceARN']}
         }
+    )
+
+
+def requeue(queue_records):
+    # Records that were never started are sent again as new messages rather
+    # than reported as failed: every receive counts toward the redrive
+    # policy's maxReceiveCount, and a queue that keeps running out of time
+    # would dead letter messages nobody tried. Returns the ids of the records
+    # that could not be sent, those are handed back as failures instead.
+    failed = set()
+    by_queue = {}
+    for queue_record in queue_records:
+        by_queue.setdefault(queue_record['eventSourceARN'], []).append(queue_record)
+    for arn, entries in by_queue.items():
+        for start in range(0, len(entries), 10):
+            chunk = entries[start:start + 10]
+            try:
+                response = sqs_client.send_message_batch(
+                    QueueUrl=queue_url(arn),
+                    Entries=[{'Id': str(i), 'MessageBody': queue_record['body']}
+                             for i, queue_record in enumerate(chunk)]
+                )
+            except Exception as e:
+                print(f"[WARN] Could not requeue {len(chunk)} message(s): {e}")
+                failed.update(record_id(queue_record) for queue_record in chunk)
+                continue
+            for failure in response.get('Failed', []):
+                failed.add(record_id(chunk[int(failure['Id'])]))
+    return failed
+
+
+def set_visibility(delays):
+    # delays is [(queue record, seconds)]. Failed records come back after a
+    # backoff that grows with every receive, records that were not started
+    # and could not be requeued come back at once. Best effort: a record
+    # whose visibility cannot be changed is still retried once its
+    # visibility timeout runs out.
+    by_queue = {}
+    for queue_record, seconds in delays:
+        by_queue.setdefault(queue_record['eventSourceARN'], []).append((queue_record, seconds))
+    for arn, entries in by_queue.items():
+        for start in range(0, len(entries), 10):
+            chunk = entries[start:start + 10]
+            try:
+                sqs_client.change_message_visibility_batch(
+                    QueueUrl=queue_url(arn),
+                    Entries=[{'Id': str(i), 'ReceiptHandle': queue_record['receiptHandle'], 'VisibilityTimeout': seconds}
+                             for i, (queue_record, seconds) in enumerate(chunk)]
+                )
+            except Exception as e:
+                print(f"[WARN] Could not change the visibility of {len(chunk)} message(s): {e}")
+
 
-    for record in event['Records']:
-        message = json.loads(record['Sns']['Message'])
-        object_key = message['object_key']
-        
-        bucket = '5225-a3-image'
-        thumbnail_bucket = '5225-a3-thumbnails'
-        thumbnail_key = "thumb-" + object_key 
-        
+@instrumented
+def lambda_handler(event, context):
+    records = event.get('Records', [])
+    by_id = {record_id(queue_record): queue_record for queue_record in records}
+    results = {}
+    failures = []
+    delays = []
+    deferred = []
+    dead_lettered = 0
+
+    def fail(message_id, object_key, e, retry=True, poison=None):
+        # poison overrides is_permanent for errors that are not about the message
+        nonlocal dead_lettered
+        print(f"[ERROR] {object_key or message_id}: {e}")
+        results[message_id] = {'object_key': object_key, 'status': 'error', 'error': str(e)}
+        queue_record = by_id.get(message_id, {})
+        if 'receiptHandle' in queue_record:
+            if not retry:
+                # not started before the deadline, sent again as a new message
+                results[message_id]['status'] = 'deferred'
+                deferred.append(queue_record)
+                return
+            elif DLQ_URL and (is_permanent(e) if poison is None else poison):
+                try:
+                    dead_letter(queue_record, e)
+                    results[message_id]['status'] = 'dead_lettered'
+                    dead_lettered += 1
+                    return
+                except Exception as dlq_error:
+                    print(f"[WARN] Could not dead letter {message_id}: {dlq_error}")
+            else:
+                backoff = RETRY_BASE_SECONDS * 2 ** (receive_count(queue_record) - 1)
+                delays.append((queue_record, min(backoff, MAX_RETRY_SECONDS)))
+        failures.append({'itemIdentifier': message_id})
+
+    # Results of images seen before come from the detection cache, the
+    # rest are retrieved and decoded before any inference runs
+    pending = []
+    for queue_record in records:
+        message_id = record_id(queue_record)
+        object_key = None
+        if out_of_time(context, 0):
+            fail(message_id, object_key, TimeoutError('Not started before the function deadline'), retry=False)
+            continue
+        try:
+            message = parse_message(queue_record)
+            object_key = message['object_key']
+            with stage('cache_lookup'):
+                cached = lookup(message['content_sha256'], message.get('phash')) if message.get('content_sha256') else None
+            if cached is not None:
+                store_result(object_key, cached, message.get('thumbnail_key'), message.get('rendition_keys'))
+                results[message_id] = {'object_key': object_key, 'status': 'ok', 'tags': cached['tags'], 'cached': True}
+                continue
+            pending.append((message_id, message, load_image(message)))
+        except Exception as e:
+            fail(message_id, object_key, e)
+
+    if pending:
         try:
-            # Retrieve original image
-            img_response = s3_client.get_object(Bucket=bucket, Key=object_key)
-            img_data = img_response['Body'].read()
-            np_array = np.fromstring(img_data, np.uint8)
-            image = cv2.imdecode(np_array, cv2.IMREAD_COLOR)
-            
-            # Perform object detection using YOLO
-            tags = do_prediction(image, nets, Lables)
-            
-            # Generate unique ID for the image
-            id = str(uuid.uuid4())
-            
-            # Store metadata in DynamoDB
-            item = {
-                'id': {'S': id},
-                's3_url': {'S': f'https://{bucket}.s3.ap-southeast-2.amazonaws.com/{object_key}'},
-                'thumbnail_url': {'S': f'https://{thumbnail_bucket}.s3.ap-southeast-2.amazonaws.com/{thumbnail_key}'},
-                'tags': {'S': json.dumps(tags)}
-            }
-
-            dynamodb.put_item(TableName=TABLE_NAME, Item=item)
-            print(f"Putting {item} into {TABLE_NAME} sucess.")
-            return {
-                'statusCode': 200,
-                'body': json.dumps('Image metadata stored successfully')
-            }
-        
+            # load the neural net, reused across invocations on a warm container
+            from yolo_model import get_model, predict
+            with stage('model_load'):
+                model = get_model(PROFILE)
         except Exception as e:
-            print(e)
-            return {
-                'statusCode': 400,
-                'body': json.dumps('Error processing image')
-            }
+            print("Fail to load yolo_tiny_configs......")
+            print(f"Error: {str(e)}")
+            # missing or broken model files say nothing about the images,
+            # always retry them
+            for message_id, message, _ in pending:
+                fail(message_id, message['object_key'], e, poison=False)
+            pending = []
+
+    # Perform object detection using YOLO, one forward pass per chunk. A
+    # chunk is only started when there is time left for one as long as the
+    # slowest so far, the rest is handed back to the queue.
+    slowest_ms = 0
+    for start in range(0, len(pending), BATCH_SIZE):
+        chunk = pending[start:start + BATCH_SIZE]
+        if out_of_time(context, slowest_ms):
+            for message_id, message, _ in pending[start:]:
+                fail(message_id, message['object_key'], TimeoutError('Not started before the function deadline'),
+                     retry=False)
+            break
+        chunk_start = time.perf_counter()
+        try:
+            predictions = predict([image for _, _, image in chunk], model)
+        except Exception as e:
+            for message_id, message, _ in chunk:
+                fail(message_id, message['object_key'], e)
+            continue
+
+        for (message_id, message, _), tags in zip(chunk, predictions):
+            object_key = message['object_key']
+            try:
+                if message.get('content_sha256'):
+                    store(message['content_sha256'], tags, message.get('phash'))
+                store_result(object_key, tags, message.get('thumbnail_key'), message.get('rendition_keys'))
+                results[message_id] = {'object_key': object_key, 'status': 'ok', 'tags': tags['tags']}
+            except Exception as e:
+                fail(message_id, object_key, e)
+        slowest_ms = max(slowest_ms, (time.perf_counter() - chunk_start) * 1000)
+
+    if deferred:
+        for message_id in requeue(deferred):
+            failures.append({'itemIdentifier': message_id})
+            delays.append((by_id[message_id], 0))
+    if delays:
+        set_visibility(delays)
+
+    log_stats()
+    record('records', len(records))
+    record('failures', len(failures))
+    record('dead_lettered', dead_lettered)
+    record('deferred', len(deferred))
+    # how long the oldest record of the batch waited on the queue
+    sent = [int(queue_record['attributes']['SentTimestamp']) for queue_record in records
+            if 'SentTimestamp' in queue_record.get('attributes', {})]
+    if sent:
+        record('queue_age_ms', int(time.time() * 1000) - min(sent), 'Milliseconds')
+    return {
+        'statusCode': 207 if failures else 200,
+        'body': json.dumps(list(results.values())),
+        'batchItemFailures': failures
+    }
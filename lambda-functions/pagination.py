@@ -0,0 +1,65 @@
+import base64
+import json
+from decimal import Decimal
+from itertools import islice
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f'Cannot encode {type(value).__name__} in a continuation token')
+
+
+def encode_token(key):
+    # opaque to the client, it is just the DynamoDB key to resume after
+    raw = json.dumps(key, default=_json_default, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_token(token):
+    if not token:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except ValueError:
+        raise ValueError('Invalid continuation token')
+    if not isinstance(key, dict):
+        raise ValueError('Invalid continuation token')
+    return key
+
+
+def parse_limit(value):
+    if value is None:
+        return DEFAULT_LIMIT
+    limit = int(value)
+    if limit < 1:
+        raise ValueError('limit must be a positive integer')
+    return min(limit, MAX_LIMIT)
+
+
+def iter_pages(operation, **kwargs):
+    # follow LastEvaluatedKey lazily so only one DynamoDB page is held at a time
+    while True:
+        response = operation(**kwargs)
+        yield response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def iter_items(operation, **kwargs):
+    for page in iter_pages(operation, **kwargs):
+        yield from page
+
+
+def take_page(items, limit, key_names):
+    # Resuming from the key of the last returned item is valid for both Query
+    # and Scan, so the token never depends on where DynamoDB split its pages.
+    items = iter(items)
+    page = list(islice(items, limit))
+    if len(page) < limit or next(items, None) is None:
+        return page, None
+    return page, encode_token({name: page[-1][name] for name in key_names})
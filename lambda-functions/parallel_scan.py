@@ -0,0 +1,40 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from pagination import iter_items
+
+# Segments are scanned concurrently; each one is mostly waiting on the
+# network so a few per vCPU keeps the function busy.
+SCAN_SEGMENTS = int(os.environ.get('SCAN_SEGMENTS', str((os.cpu_count() or 1) * 4)))
+
+
+def projection_kwargs(fields):
+    names = {f'#p{i}': field for i, field in enumerate(fields)}
+    return {
+        'ProjectionExpression': ', '.join(names),
+        'ExpressionAttributeNames': names
+    }
+
+
+def _scan_segment(client, kwargs, segment, total_segments):
+    return list(iter_items(client.scan, Segment=segment, TotalSegments=total_segments, **kwargs))
+
+
+def parallel_scan(table, fields=None, filter_expression=None, total_segments=None, max_workers=None):
+    # The low level client is thread safe (resources are not), and the one
+    # behind a resource Table still accepts conditions and plain python types.
+    total_segments = total_segments or SCAN_SEGMENTS
+    client = table.meta.client
+    kwargs = {'TableName': table.name}
+    if fields:
+        kwargs.update(projection_kwargs(fields))
+    if filter_expression is not None:
+        kwargs['FilterExpression'] = filter_expression
+
+    with ThreadPoolExecutor(max_workers=max_workers or total_segments) as pool:
+        futures = [pool.submit(_scan_segment, client, kwargs, segment, total_segments)
+                   for segment in range(total_segments)]
+        items = []
+        for future in futures:
+            items.extend(future.result())
+    return items
@@ -0,0 +1,133 @@
+import json
+import math
+import os
+import aws_clients
+from botocore.exceptions import ClientError
+from instrumentation import instrumented
+
+s3_client = aws_clients.client('s3')
+
+IMAGE_BUCKET = '5225-a3-image'
+URL_EXPIRY = int(os.environ.get('UPLOAD_URL_EXPIRY', '900'))
+# files above this size are uploaded in parts straight from the browser
+MULTIPART_THRESHOLD = int(os.environ.get('MULTIPART_THRESHOLD', str(32 * 1024 * 1024)))
+PART_SIZE = int(os.environ.get('MULTIPART_PART_SIZE', str(16 * 1024 * 1024)))  # S3 minimum is 5 MB
+MAX_PARTS = 10000
+# the size is only the client's word, it decides how many part URLs are
+# signed and returned
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', str(100 * 1024 * 1024)))
+
+HEADERS = {
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS',
+    'Access-Control-Allow-Headers': '*'
+}
+
+def response(status_code, body):
+    return {
+        'statusCode': status_code,
+        'headers': HEADERS,
+        'body': json.dumps(body)
+    }
+
+def caller_email(event, body):
+    # prefer the verified Cognito claim when the API uses the user pool authorizer
+    claims = (event.get('requestContext') or {}).get('authorizer', {}).get('claims', {})
+    return claims.get('email') or body.get('user_email')
+
+def start_upload(image_name, user_email, content_type, size):
+    metadata = {'user_email': user_email}
+
+    if size <= MULTIPART_THRESHOLD:
+        # Content-Type and the metadata are part of the signature, the
+        # browser has to send exactly these headers with the PUT
+        url = s3_client.generate_presigned_url(
+            'put_object',
+            Params={'Bucket': IMAGE_BUCKET, 'Key': image_name, 'ContentType': content_type, 'Metadata': metadata},
+            ExpiresIn=URL_EXPIRY
+        )
+        return {
+            'key': image_name,
+            'method': 'PUT',
+            'url': url,
+            'headers': {'Content-Type': content_type, 'x-amz-meta-user_email': user_email}
+        }
+
+    part_size = max(PART_SIZE, math.ceil(size / MAX_PARTS))
+    upload = s3_client.create_multipart_upload(
+        Bucket=IMAGE_BUCKET, Key=image_name, ContentType=content_type, Metadata=metadata
+    )
+    upload_id = upload['UploadId']
+    parts = [
+        {
+            'part_number': part_number,
+            'url': s3_client.generate_presigned_url(
+                'upload_part',
+                Params={'Bucket': IMAGE_BUCKET, 'Key': image_name, 'UploadId': upload_id, 'PartNumber': part_number},
+                ExpiresIn=URL_EXPIRY
+            )
+        }
+        for part_number in range(1, math.ceil(size / part_size) + 1)
+    ]
+    return {
+        'key': image_name,
+        'upload_id': upload_id,
+        'part_size': part_size,
+        'parts': parts
+    }
+
+def complete_upload(image_name, upload_id, parts):
+    if upload_id:
+        s3_client.complete_multipart_upload(
+            Bucket=IMAGE_BUCKET,
+            Key=image_name,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': sorted(
+                ({'PartNumber': int(part['PartNumber']), 'ETag': part['ETag']} for part in parts),
+                key=lambda part: part['PartNumber']
+            )}
+        )
+    # confirm the object landed
+    head = s3_client.head_object(Bucket=IMAGE_BUCKET, Key=image_name)
+    return {'key': image_name, 'size': head['ContentLength'], 'etag': head['ETag'].strip('"')}
+
+@instrumented
+def lambda_handler(event, context):
+    # Handle CORS preflight request
+    if event.get('httpMethod') == 'OPTIONS':
+        return response(200, 'CORS preflight response')
+
+    try:
+        body = json.loads(event.get('body') or '{}')
+        action = body.get('action', 'start')
+        image_name = body['image_name']
+    except (KeyError, ValueError) as e:
+        print(f"Invalid request body: {e}")
+        return response(400, 'Request body must contain "image_name"')
+
+    try:
+        if action == 'start':
+            user_email = caller_email(event, body)
+            if not user_email:
+                return response(400, 'Request body must contain "user_email"')
+            content_type = body.get('content_type') or 'application/octet-stream'
+            size = int(body.get('size') or 0)
+            if not 0 <= size <= MAX_UPLOAD_BYTES:
+                return response(400, f'"size" must be between 0 and {MAX_UPLOAD_BYTES} bytes')
+            return response(200, start_upload(image_name, user_email, content_type, size))
+
+        if action == 'complete':
+            return response(200, complete_upload(image_name, body.get('upload_id'), body.get('parts', [])))
+
+        if action == 'abort':
+            s3_client.abort_multipart_upload(Bucket=IMAGE_BUCKET, Key=image_name, UploadId=body['upload_id'])
+            return response(200, {'key': image_name, 'aborted': True})
+
+        return response(400, f'Unknown action "{action}"')
+    except (KeyError, ValueError) as e:
+        print(f"Invalid request body: {e}")
+        return response(400, f'Invalid request: {e}')
+    except ClientError as e:
+        print(f"Error talking to S3: {e}")
+        return response(500, 'Error preparing the upload')
@@ -1,14 +1,19 @@
 import json
-import boto3
-from boto3.dynamodb.conditions import Attr
+import os
+from instrumentation import instrumented, record, stage
+from pagination import parse_limit
+from parallel_scan import SCAN_SEGMENTS
+from query_cache import cached, log_stats
+from tag_index import parse_constraints, query_tags, scan_tags
 
-dynamodb = boto3.resource('dynamodb')
-table_name = 'database' 
-table = dynamodb.Table(table_name)
+# 'index' (default) or 'scan' while the tag index is not populated yet
+SEARCH_MODE = os.environ.get('SEARCH_MODE', 'index')
+# a full scan costs a read of the whole table, so clients may only ask for
+# one on deployments meant for admin queries
+ALLOW_SCAN_REQUESTS = os.environ.get('ALLOW_SCAN_REQUESTS', '0') == '1'
 
+@instrumented
 def lambda_handler(event, context):
-    print('event')
-    
     # print('remaining time =', context.getRemainingTimeInMillis())
     # print('functionName =', context.functionName)
     # print('AWSrequestID =', context.awsRequestId)
@@ -39,25 +44,45 @@ def lambda_handler(event, context):
         if event['httpMethod'] == 'POST':
             body = json.loads(event['body']) if 'body' in event else {}
             if 'tags' in body:
+                # a list of tags, or {tag: minimum count} such as
+                # {"person": 2, "dog": 1} for "at least two people and a dog"
                 tags = body['tags']
-                if not isinstance(tags, list):
+                if not isinstance(tags, (list, dict)):
                     tags = [tags]
 
-                if tags:
-                    filter_expression = None
+                # the same search from any user is answered from the
+                # container's cache until an image with one of its tags changes
+                constraints = parse_constraints(tags)
 
-                    for tag in tags:
-                        if filter_expression is None:
-                            filter_expression = Attr('tags').contains(tag)
-                        else:
-                            filter_expression = filter_expression & Attr('tags').contains(tag)
-
-                    response = table.scan(
-                        FilterExpression=filter_expression
-                    )
-                    response_body = [item['thumbnail_url'] for item in response['Items']]
+                if body.get('scan') and not ALLOW_SCAN_REQUESTS:
+                    raise ValueError('Scan requests are not enabled')
+                if body.get('scan') or SEARCH_MODE == 'scan':
+                    # full parallel scan, for admin queries or before the
+                    # tag index exists, always a single page
+                    segments = None
+                    if ALLOW_SCAN_REQUESTS and body.get('segments'):
+                        segments = min(max(int(body['segments']), 1), SCAN_SEGMENTS)
+                    with stage('scan'):
+                        items = cached(constraints, ('scan',),
+                                       lambda: [item['thumbnail_url'] for item in scan_tags(constraints, segments)])
+                    response_body = {
+                        'items': items,
+                        'next_token': None
+                    }
                 else:
-                    raise ValueError('Tags are required')
+                    # exact tag matches from the inverted index, intersected
+                    # for AND queries, one page at a time
+                    limit = parse_limit(body.get('limit'))
+                    next_token = body.get('next_token')
+                    with stage('query'):
+                        items, next_token = cached(constraints, ('index', limit, next_token),
+                                                   lambda: query_tags(constraints, limit, next_token))
+                    response_body = {
+                        'items': items,
+                        'next_token': next_token
+                    }
+                    record('results', len(items))
+                log_stats()
             else:
                 raise ValueError('Tags are missing')
 
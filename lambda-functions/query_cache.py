@@ -0,0 +1,112 @@
+import os
+import time
+from collections import OrderedDict
+
+import aws_clients
+from instrumentation import record
+
+# Search results cached per container, keyed by the normalized tag query.
+# Every tag has a version counter in VERSIONS_TABLE (partition key 'scope':
+# 'tag#<tag>', or 'global' for all of them) that writers bump when an image
+# with that tag is added, re-tagged or deleted. A cached result is only
+# served while the versions of its tags are the ones it was computed with,
+# so a hit costs one small BatchGetItem instead of a query or a scan.
+VERSIONS_TABLE = os.environ.get('CACHE_VERSIONS_TABLE', 'cache-versions')
+versions_table = aws_clients.table(VERSIONS_TABLE)
+dynamodb = aws_clients.resource('dynamodb')
+
+ENABLED = os.environ.get('QUERY_CACHE', '1') == '1'
+MAX_ENTRIES = int(os.environ.get('QUERY_CACHE_ENTRIES', '256'))
+# upper bound on staleness should a writer fail to bump a version
+TTL_SECONDS = int(os.environ.get('QUERY_CACHE_TTL', '300'))
+GLOBAL_SCOPE = 'global'
+BATCH_GET_SIZE = 100
+
+_entries = OrderedDict()  # key -> (versions, expires_at, result)
+stats = {'hits': 0, 'misses': 0, 'stale': 0}
+
+
+def _scope(tag):
+    return 'tag#' + tag
+
+
+def current_versions(tags):
+    # (global version, version of each tag in sorted order); tags nobody
+    # has written yet are at version 0
+    scopes = [GLOBAL_SCOPE] + [_scope(tag) for tag in sorted(tags)]
+    found = {}
+    for start in range(0, len(scopes), BATCH_GET_SIZE):
+        pending = {VERSIONS_TABLE: {'Keys': [{'scope': scope} for scope in scopes[start:start + BATCH_GET_SIZE]],
+                                    'ProjectionExpression': '#scope, #version',
+                                    'ExpressionAttributeNames': {'#scope': 'scope', '#version': 'version'}}}
+        while pending:
+            response = dynamodb.batch_get_item(RequestItems=pending)
+            for item in response['Responses'].get(VERSIONS_TABLE, []):
+                found[item['scope']] = int(item['version'])
+            pending = response.get('UnprocessedKeys') or {}
+    return tuple(found.get(scope, 0) for scope in scopes)
+
+
+def cached(constraints, variant, compute):
+    # constraints is the normalized {tag: minimum count} of the query,
+    # variant whatever else changes the result (mode, page size, token)
+    if not ENABLED:
+        return compute()
+    key = (tuple(sorted(constraints.items())), variant)
+    try:
+        versions = current_versions(constraints)
+    except Exception as e:
+        # the cache must never fail a search
+        print(f"[WARN] query cache version check failed: {e}")
+        return compute()
+
+    entry = _entries.get(key)
+    if entry is not None:
+        if entry[0] == versions and entry[1] > time.time():
+            _entries.move_to_end(key)
+            stats['hits'] += 1
+            record('query_cache_hit', 1)
+            return entry[2]
+        stats['stale'] += 1
+    stats['misses'] += 1
+    record('query_cache_hit', 0)
+
+    # versions were read before computing: a write racing with this query
+    # leaves the entry stale rather than hiding the write
+    result = compute()
+    _entries[key] = (versions, time.time() + TTL_SECONDS, result)
+    _entries.move_to_end(key)
+    while len(_entries) > MAX_ENTRIES:
+        _entries.popitem(last=False)
+    return result
+
+
+def _bump(scope):
+    versions_table.update_item(
+        Key={'scope': scope},
+        UpdateExpression='ADD #version :one',
+        ExpressionAttributeNames={'#version': 'version'},
+        ExpressionAttributeValues={':one': 1}
+    )
+
+
+def bump(tags):
+    # Called by every writer after changing images with these tags. A
+    # failure is logged, never raised: the TTL bounds the staleness.
+    for scope in sorted({_scope(tag) for tag in tags if tag}):
+        try:
+            _bump(scope)
+        except Exception as e:
+            print(f"[WARN] Could not bump the cache version of {scope}: {e}")
+
+
+def bump_all():
+    # invalidates every cached search, after bulk changes such as a backfill
+    _bump(GLOBAL_SCOPE)
+
+
+def log_stats():
+    lookups = stats['hits'] + stats['misses']
+    if lookups:
+        print(f"[INFO] query cache: {stats['hits']} hits, {stats['misses']} misses "
+              f"({stats['stale']} stale), hit rate {100.0 * stats['hits'] / lookups:.1f}%")
@@ -1,76 +1,29 @@
-import boto3
 import json
-import cv2
-import numpy as np
-import time
-from boto3.dynamodb.conditions import Attr
+import os
 from base64 import b64decode
-
-s3_client = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb')
-table_name = 'database' 
-table = dynamodb.Table(table_name)
-
-DETECTION_BUCKET = '5225-a3-detection-files'
-YOLO_FILES = ['coco.names', 'yolov3-tiny.cfg', 'yolov3-tiny.weights']
-
-confthres = 0.3
-nmsthres = 0.1
-
-def load_model(configpath, weightspath):
-    print("[INFO] loading YOLO from disk...")
-    net = cv2.dnn.readNetFromDarknet(configpath, weightspath)
-    return net
-
-def do_prediction(image, net, LABELS):
-    (H, W) = image.shape[:2]
-    ln = net.getLayerNames()
-    ln = [ln[i - 1] for i in net.getUnconnectedOutLayers()]
-
-    blob = cv2.dnn.blobFromImage(image, 1 / 255.0, (416, 416), swapRB=True, crop=False)
-    net.setInput(blob)
-    start = time.time()
-    layerOutputs = net.forward(ln)
-    end = time.time()
-
-    print("[INFO] YOLO took {:.6f} seconds".format(end - start))
-
-    boxes = []
-    confidences = []
-    classIDs = []
-
-    for output in layerOutputs:
-        for detection in output:
-            scores = detection[5:]
-            classID = np.argmax(scores)
-            confidence = scores[classID]
-
-            if confidence > confthres:
-                box = detection[0:4] * np.array([W, H, W, H])
-                (centerX, centerY, width, height) = box.astype("int")
-
-                x = int(centerX - (width / 2))
-                y = int(centerY - (height / 2))
-
-                boxes.append([x, y, int(width), int(height)])
-                confidences.append(float(confidence))
-                classIDs.append(classID)
-
-    idxs = cv2.dnn.NMSBoxes(boxes, confidences, confthres, nmsthres)
-
-    results = {"tags": []}
-    if len(idxs) > 0:
-        for i in idxs.flatten():
-            if confidences[i] < 0.5:
-                continue
-            results["tags"].append(LABELS[classIDs[i]])
-            
-    return results
-
-def download_yolo_files():
-    for file_name in YOLO_FILES:
-        s3_client.download_file(DETECTION_BUCKET, file_name, f'/tmp/{file_name}')
-
+from instrumentation import instrumented, record, record_size, stage
+from pagination import parse_limit
+
+# OpenCV, NumPy, boto3 and the model are imported where they are first
+# needed: preflight and invalid requests answer without loading any of
+# them, and an exact cache hit never decodes the image.
+
+# 'index' (default) or 'scan' while the tag index is not populated yet
+SEARCH_MODE = os.environ.get('SEARCH_MODE', 'index')
+# 'similarity' (default) ranks images by their detected class counts,
+# 'tags' returns every image that has all the detected tags
+IMAGE_SEARCH_MODE = os.environ.get('IMAGE_SEARCH_MODE', 'similarity')
+
+def decode_image(data):
+    import cv2
+    import numpy as np
+    with stage('decode'):
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Failed to decode image")
+    return image
+
+@instrumented
 def lambda_handler(event, context):
     status_code = 200
     response_body = {}
@@ -94,69 +47,89 @@ def lambda_handler(event, context):
         }
     
     try:
-        download_yolo_files()
-        labelsPath = "/tmp/coco.names"
-        with open(labelsPath, 'r') as file:
-            LABELS = file.read().strip().split("\n")
-        CFG = "/tmp/yolov3-tiny.cfg"
-        Weights = "/tmp/yolov3-tiny.weights"
-        nets = load_model(CFG, Weights)
-    except Exception as e:
-        print("Fail to load yolo_tiny_configs......")
-        print(f"Error: {str(e)}")
-        return {
-            'statusCode': 400,
-            'body': json.dumps('Error loading yolo_tiny_configs'),
-            'headers': headers
-        }
-
-    try:
-        print("[INFO] Parsing event body...")
         body = json.loads(event.get('body', '{}'))
         encoded_image = body.get('image')
         
         if not encoded_image:
             raise ValueError("Missing image data in request body")
 
-        print("[INFO] Decoding image...")
         decoded_image_data = b64decode(encoded_image)
-        np_array = np.frombuffer(decoded_image_data, np.uint8)
-        image = cv2.imdecode(np_array, cv2.IMREAD_COLOR)
-
-        if image is None:
-            raise ValueError("Failed to decode image")
-
-        print("[INFO] Running prediction...")
-        tags = do_prediction(image, nets, LABELS)
+        record_size('image', len(decoded_image_data))
+
+        from detection_cache import content_hash, log_stats, lookup, perceptual_hash, store
+
+        # Images queried (or uploaded) before skip inference entirely. The
+        # image is only decoded when there is no exact match, for the
+        # near-duplicate lookup or for inference.
+        decoded = {}
+
+        def phash():
+            decoded['image'] = decode_image(decoded_image_data)
+            return perceptual_hash(decoded['image'])
+
+        with stage('cache_lookup'):
+            sha256 = content_hash(decoded_image_data)
+            tags = lookup(sha256, phash)
+        record('cache_hit', int(tags is not None))
+        log_stats()
+
+        if tags is None:
+            image = decoded.get('image')
+            if image is None:
+                image = decode_image(decoded_image_data)
+            try:
+                from yolo_model import get_model, predict
+                with stage('model_load'):
+                    model = get_model()
+            except Exception as e:
+                print("Fail to load yolo_tiny_configs......")
+                print(f"Error: {str(e)}")
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps('Error loading yolo_tiny_configs'),
+                    'headers': headers
+                }
+
+            tags = predict([image], model)[0]
+            store(sha256, tags, perceptual_hash(image))
         print(tags)
 
         if tags['tags']:
             print("[INFO] Detected tags: ", tags['tags'])
-            print("[INFO] Building filter expression...")
-            filter_expression = None
-            for tag in tags['tags']:
-                if filter_expression is None:
-                    filter_expression = Attr('tags').contains(tag)
-                else:
-                    filter_expression = filter
-                    filter_expression & Attr('tags').contains(tag)
-
-            print("[INFO] Scanning DynamoDB table...")
-            response = table.scan(
-                FilterExpression=filter_expression
-            )
-            items = response.get('Items', [])
-            print(f"[INFO] Found {len(items)} items in DynamoDB matching tags.")
+            limit = parse_limit(body.get('limit'))
+            if IMAGE_SEARCH_MODE == 'similarity':
+                # The top `limit` images by similarity of their class
+                # counts, best first. There is no next page.
+                from similarity_index import search_similar
+                with stage('search'):
+                    items = search_similar(tags['tags'], limit)
+                next_token = None
+            else:
+                # Same index lookup as the tag search, later pages are
+                # fetched from the search endpoint with the returned tags
+                # and next_token so the image does not have to be sent and
+                # detected again.
+                from tag_index import query_tags, scan_tags
+                with stage('search'):
+                    if SEARCH_MODE == 'scan':
+                        thumbnail_urls = [item['thumbnail_url'] for item in scan_tags(tags['tags'])]
+                        next_token = None
+                    else:
+                        thumbnail_urls, next_token = query_tags(tags['tags'], limit)
+                items = [{'thumbnail_url': url} for url in thumbnail_urls]
+            print(f"[INFO] Found {len(items)} matching items.")
 
             response_body = {
                 'tags': tags['tags'],
-                'items': items
+                'items': items,
+                'next_token': next_token
             }
         else:
             print("[INFO] No tags detected in the image.")
             response_body = {
                 'tags': [],
-                'items': []
+                'items': [],
+                'next_token': None
             }
 
     except Exception as e:
@@ -0,0 +1,163 @@
+import math
+import os
+import time
+
+import numpy as np
+from boto3.dynamodb.conditions import Key
+
+import aws_clients
+from pagination import iter_items
+from parallel_scan import parallel_scan
+from tag_index import item_counts, normalize_tag
+from vector_feed import CHANGE_PARTITION, changes_table
+
+image_table = aws_clients.table('database')
+
+REFRESH_SECONDS = int(os.environ.get('SIMILARITY_REFRESH_SECONDS', '30'))
+REBUILD_SECONDS = int(os.environ.get('SIMILARITY_REBUILD_SECONDS', '3600'))
+# changes are read again from this far back, writers' clocks are not exact
+CLOCK_SKEW_MS = 5000
+
+_index = None
+
+
+class VectorIndex:
+    """Class count vectors of every image as one float32 matrix.
+
+    Each row holds 1 + log(count) per class, damped so that a crowd of
+    people does not drown out everything else. Scores are cosine
+    similarities with every class weighted by its inverse document
+    frequency, so rare classes decide the ranking.
+    """
+
+    def __init__(self):
+        self.columns = {}  # tag -> column
+        self.rows = {}  # image id -> row
+        self.ids = []
+        self.urls = []
+        self.matrix = np.zeros((1024, 16), np.float32)
+        self.df = np.zeros(16, np.int64)  # images per class
+        self.live = 0
+
+    def _column(self, tag):
+        if tag not in self.columns:
+            if len(self.columns) == self.matrix.shape[1]:
+                self.matrix = np.pad(self.matrix, ((0, 0), (0, self.matrix.shape[1])))
+                self.df = np.pad(self.df, (0, len(self.df)))
+            self.columns[tag] = len(self.columns)
+        return self.columns[tag]
+
+    def _clear(self, row):
+        was_live = self.matrix[row].any()
+        self.df -= self.matrix[row] > 0
+        self.matrix[row] = 0
+        self.live -= int(was_live)
+
+    def upsert(self, image_id, thumbnail_url, counts):
+        row = self.rows.get(image_id)
+        if row is None:
+            row = len(self.ids)
+            if row == self.matrix.shape[0]:
+                self.matrix = np.pad(self.matrix, ((0, row), (0, 0)))
+            self.rows[image_id] = row
+            self.ids.append(image_id)
+            self.urls.append(thumbnail_url)
+        else:
+            self._clear(row)
+            self.urls[row] = thumbnail_url
+        values = {self._column(tag): 1 + math.log(count) for tag, count in counts.items() if count > 0}
+        for column, value in values.items():
+            self.matrix[row, column] = value
+        self.df[list(values)] += 1
+        self.live += int(bool(values))
+
+    def remove(self, image_id):
+        row = self.rows.get(image_id)
+        if row is not None:
+            self._clear(row)
+
+    def search(self, counts, k):
+        # [(score, image id, thumbnail url)], best first
+        known = {self.columns[tag]: 1 + math.log(count)
+                 for tag, count in counts.items() if count > 0 and tag in self.columns}
+        if not known:
+            return []
+        idf = np.log((self.live + 1) / (self.df + 1)) + 1
+        columns = np.fromiter(known, np.int64)
+        query = np.fromiter(known.values(), np.float32) * idf[columns]
+        # classes no image has still count towards the query length
+        unseen = sum((1 + math.log(count)) ** 2 for tag, count in counts.items()
+                     if count > 0 and tag not in self.columns) * (math.log(self.live + 1) + 1) ** 2
+        query_norm = math.sqrt(float(query @ query) + unseen)
+
+        rows = len(self.ids)
+        dots = self.matrix[:rows, columns] @ (query * idf[columns])
+        candidates = np.flatnonzero(dots)
+        if not len(candidates):
+            return []
+        weighted = self.matrix[candidates] * idf
+        scores = dots[candidates] / (np.sqrt(np.einsum('ij,ij->i', weighted, weighted)) * query_norm)
+
+        k = min(k, len(candidates))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(float(scores[i]), self.ids[candidates[i]], self.urls[candidates[i]]) for i in top]
+
+
+class _State:
+    def __init__(self, index, built_at, since_ms):
+        self.index = index
+        self.built_at = built_at
+        self.refreshed_at = built_at
+        self.since_ms = since_ms
+
+
+def _build():
+    start = time.time()
+    index = VectorIndex()
+    for item in parallel_scan(image_table, fields=['id', 'thumbnail_url', 'tag_counts', 'tags']):
+        index.upsert(item['id'], item['thumbnail_url'], item_counts(item))
+    print(f"[INFO] Built similarity index of {index.live} images in {time.time() - start:.3f} seconds")
+    # changes written while scanning are applied again by the next refresh
+    return _State(index, time.time(), int(start * 1000))
+
+
+def _refresh(state):
+    since = f'{state.since_ms - CLOCK_SKEW_MS:013d}'
+    now_ms = int(time.time() * 1000)
+    applied = 0
+    for change in iter_items(changes_table.query,
+                             KeyConditionExpression=Key('shard').eq(CHANGE_PARTITION) & Key('seq').gt(since)):
+        if 'tag_counts' in change:
+            # the feed carries the counts of the image's current tags
+            counts = {tag: int(count) for tag, count in change['tag_counts'].items()}
+            state.index.upsert(change['image_id'], change['thumbnail_url'], counts)
+        else:
+            state.index.remove(change['image_id'])
+        applied += 1
+    state.since_ms = now_ms
+    state.refreshed_at = time.time()
+    if applied:
+        print(f"[INFO] Applied {applied} similarity index change(s)")
+
+
+def get_index():
+    # Built once per container and kept up to date from the change feed,
+    # rebuilt in full every REBUILD_SECONDS.
+    global _index
+    now = time.time()
+    if _index is None or now - _index.built_at > REBUILD_SECONDS:
+        _index = _build()
+    elif now - _index.refreshed_at > REFRESH_SECONDS:
+        _refresh(_index)
+    return _index.index
+
+
+def search_similar(tags, k):
+    counts = {}
+    for tag in tags:
+        tag = normalize_tag(tag)
+        if tag:
+            counts[tag] = counts.get(tag, 0) + 1
+    return [{'thumbnail_url': url, 'score': round(score, 4)}
+            for score, image_id, url in get_index().search(counts, k)]
@@ -0,0 +1,103 @@
+import json
+import os
+
+from boto3.dynamodb.conditions import Key
+
+import aws_clients
+from pagination import iter_items
+from tag_index import normalize_tag
+
+sns_client = aws_clients.client('sns')
+
+# Reverse index maintained by automatic.py from the user-tags stream:
+# partition key 'tag', sort key 'user_email'.
+SUBSCRIBERS_TABLE = 'tag-subscribers'
+subscribers_table = aws_clients.table(SUBSCRIBERS_TABLE)
+TOPIC_ARN = os.environ.get('NOTIFICATION_TOPIC_ARN', 'arn:aws:sns:ap-southeast-2:992382579935:ImageTagNotifications')
+PUBLISH_BATCH_SIZE = 10  # PublishBatch limit
+
+
+def find_subscribers(tags):
+    # {user_email: matched tags}, one Query per distinct tag of the image so
+    # the cost follows the number of interested users, not all users
+    matches = {}
+    for tag in {normalize_tag(t) for t in tags} - {''}:
+        for item in iter_items(subscribers_table.query, KeyConditionExpression=Key('tag').eq(tag),
+                               ProjectionExpression='user_email'):
+            matches.setdefault(item['user_email'], set()).add(tag)
+    return matches
+
+
+def build_message(user_email, tags, thumbnail_url):
+    return {
+        'Subject': 'New image matching your tags',
+        'Message': f"A new image tagged {', '.join(sorted(tags))} was uploaded: {thumbnail_url}",
+        # every email subscription has a {"user_email": [...]} filter policy
+        'MessageAttributes': {'user_email': {'DataType': 'String', 'StringValue': user_email}}
+    }
+
+
+def publish(messages):
+    # messages is a list of build_message() results, sent with PublishBatch.
+    # Returns the positions in messages of the ones SNS did not accept.
+    failed = set()
+    for start in range(0, len(messages), PUBLISH_BATCH_SIZE):
+        entries = [dict(message, Id=str(start + i))
+                   for i, message in enumerate(messages[start:start + PUBLISH_BATCH_SIZE])]
+        response = sns_client.publish_batch(TopicArn=TOPIC_ARN, PublishBatchRequestEntries=entries)
+        for failure in response.get('Failed', []):
+            failed.add(int(failure['Id']))
+            print(f"[WARN] notification publish failed: {json.dumps(failure)}")
+    return failed
+
+
+def notify_subscribers(tags, thumbnail_url):
+    matches = find_subscribers(tags)
+    if not matches:
+        return 0
+    messages = [build_message(user_email, matched, thumbnail_url) for user_email, matched in matches.items()]
+    publish(messages)
+    return len(messages)
+
+
+def subscription_tags(item):
+    # subscribed_tags is a string set, or a list on users who have not
+    # changed their subscription since before the set was introduced
+    tags = item.get('subscribed_tags') or []
+    if isinstance(tags, str):
+        tags = [tags]
+    return {normalize_tag(tag) for tag in tags} - {''}
+
+
+def backfill():
+    # one-off: the reverse index and the filter policies are only written
+    # when a user subscribes or changes tags, so users who did so before
+    # they existed would not get any notification
+    users_table = aws_clients.table('user-tags')
+    count = 0
+    with subscribers_table.batch_writer(overwrite_by_pkeys=['tag', 'user_email']) as batch:
+        for item in iter_items(users_table.scan, ProjectionExpression='#id, subscribed_tags',
+                               ExpressionAttributeNames={'#id': 'id'}):
+            for tag in subscription_tags(item):
+                batch.put_item(Item={'tag': tag, 'user_email': item['id']})
+            count += 1
+    print(f"[INFO] Indexed the subscriptions of {count} users into {SUBSCRIBERS_TABLE}")
+
+    # without a filter policy a subscription receives every user's messages
+    policies = 0
+    for page in sns_client.get_paginator('list_subscriptions_by_topic').paginate(TopicArn=TOPIC_ARN):
+        for subscription in page['Subscriptions']:
+            # pending confirmations have no ARN yet and cannot be changed
+            if subscription['Protocol'] != 'email' or not subscription['SubscriptionArn'].startswith('arn:'):
+                continue
+            sns_client.set_subscription_attributes(
+                SubscriptionArn=subscription['SubscriptionArn'],
+                AttributeName='FilterPolicy',
+                AttributeValue=json.dumps({'user_email': [subscription['Endpoint']]})
+            )
+            policies += 1
+    print(f"[INFO] Set the filter policy of {policies} subscriptions to {TOPIC_ARN}")
+
+
+if __name__ == '__main__':
+    backfill()
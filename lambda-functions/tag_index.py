@@ -0,0 +1,213 @@
+import json
+from collections import Counter
+
+import aws_clients
+from pagination import DEFAULT_LIMIT, decode_token, iter_items, iter_pages, take_page
+from parallel_scan import parallel_scan
+from query_cache import bump_all
+
+dynamodb = aws_clients.resource('dynamodb')
+
+# One item per (tag, image) pair: partition key 'tag', sort key 'image_id'.
+# The thumbnail URL is copied onto the posting so searches never have to go
+# back to the image table. 'count' is how many objects with that tag the
+# detection found, the GSI 'tag-count-index' (tag + count) answers "at
+# least n" with a range condition.
+TAG_INDEX_TABLE = 'tag-index'
+COUNT_INDEX = 'tag-count-index'
+index_table = aws_clients.table(TAG_INDEX_TABLE)
+image_table = aws_clients.table('database')
+
+# posting lists longer than this are all treated as equally unselective
+PROBE_LIMIT = 100
+
+
+def normalize_tag(tag):
+    return tag.strip().lower()
+
+
+def item_tags(item):
+    # tags are a string set, older items still have the JSON encoded
+    # detection result {"tags": [...]}
+    tags = item.get('tags')
+    if isinstance(tags, str):
+        tags = json.loads(tags).get('tags', [])
+    return list(tags or [])
+
+
+def parse_constraints(tags):
+    # {tag: minimum count} from a list of tags (at least one of each) or a
+    # {tag: count} mapping
+    if isinstance(tags, str):
+        tags = [tags]
+    if not isinstance(tags, dict):
+        tags = {tag: 1 for tag in tags}
+    constraints = {}
+    for tag, count in tags.items():
+        tag = normalize_tag(tag)
+        count = int(count)
+        if count < 1:
+            raise ValueError(f'Count of {tag} must be at least 1')
+        if tag:
+            constraints[tag] = max(count, constraints.get(tag, 1))
+    if not constraints:
+        raise ValueError('Tags are required')
+    return constraints
+
+
+def add_postings(image_id, tags, thumbnail_url, counts=None):
+    # tags is the detection result (one entry per object) unless counts
+    # gives the number of objects per tag
+    counts = counts or Counter(normalize_tag(t) for t in tags)
+    with index_table.batch_writer(overwrite_by_pkeys=['tag', 'image_id']) as batch:
+        for tag in {normalize_tag(t) for t in tags}:
+            batch.put_item(Item={
+                'tag': tag,
+                'image_id': image_id,
+                'thumbnail_url': thumbnail_url,
+                'count': max(int(counts.get(tag, 1)), 1)
+            })
+
+
+def remove_postings(image_id, tags):
+    with index_table.batch_writer(overwrite_by_pkeys=['tag', 'image_id']) as batch:
+        for tag in {normalize_tag(t) for t in tags}:
+            batch.delete_item(Key={'tag': tag, 'image_id': image_id})
+
+
+def _posting_query(tag, min_count):
+    # conditions are imported where they are used, importing them loads all
+    # of boto3 and handlers that only validate a request should not pay that
+    from boto3.dynamodb.conditions import Key
+    # "at least one" is the whole posting list, higher counts are a range
+    # on the count index
+    if min_count <= 1:
+        return {'KeyConditionExpression': Key('tag').eq(tag)}
+    return {'IndexName': COUNT_INDEX, 'KeyConditionExpression': Key('tag').eq(tag) & Key('count').gte(min_count)}
+
+
+def _estimate_postings(tag, min_count=1):
+    # cheap, bounded probe of a posting list length: exact below PROBE_LIMIT
+    response = index_table.query(Select='COUNT', Limit=PROBE_LIMIT, **_posting_query(tag, min_count))
+    return response['Count'] if 'LastEvaluatedKey' not in response else PROBE_LIMIT
+
+
+def _present(image_ids, tags):
+    # {(tag, image_id): count} of the postings that exist, looked up with
+    # BatchGetItem. Postings written before counts were indexed count 1.
+    keys = [{'tag': tag, 'image_id': image_id} for image_id in image_ids for tag in tags]
+    found = {}
+    for start in range(0, len(keys), 100):
+        request = {TAG_INDEX_TABLE: {
+            'Keys': keys[start:start + 100],
+            'ProjectionExpression': 'tag, image_id, #count',
+            'ExpressionAttributeNames': {'#count': 'count'}
+        }}
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(TAG_INDEX_TABLE, []):
+                found[(item['tag'], item['image_id'])] = int(item.get('count', 1))
+            request = response.get('UnprocessedKeys')
+    return found
+
+
+def choose_driver(constraints, start_key=None):
+    # the most selective constraint, or the one a continuation token walks
+    if not start_key:
+        return min(sorted(constraints), key=lambda tag: _estimate_postings(tag, constraints[tag]))
+    driver = start_key.get('tag')
+    if driver not in constraints or 'image_id' not in start_key \
+            or ('count' in start_key) != (constraints[driver] > 1):
+        raise ValueError('Continuation token does not match the query')
+    return driver
+
+
+def page_key_names(constraints, driver):
+    # the count index pages by (tag, count, image_id), the table by (tag, image_id)
+    return ['tag', 'image_id', 'count'] if constraints[driver] > 1 else ['tag', 'image_id']
+
+
+def iter_matches(tags, start_key=None, page_size=100, driver=None):
+    # AND query: walk the postings of the most selective constraint (the
+    # driver) page by page and keep the images that also meet every other one
+    constraints = parse_constraints(tags)
+    driver = driver or choose_driver(constraints, start_key)
+    others = {tag: count for tag, count in constraints.items() if tag != driver}
+
+    kwargs = dict(_posting_query(driver, constraints[driver]),
+                  ProjectionExpression='tag, image_id, thumbnail_url, #count',
+                  ExpressionAttributeNames={'#count': 'count'},
+                  Limit=page_size)
+    if start_key:
+        kwargs['ExclusiveStartKey'] = dict(start_key, tag=driver)
+
+    for page in iter_pages(index_table.query, **kwargs):
+        if not others:
+            yield from page
+            continue
+        found = _present([item['image_id'] for item in page], others)
+        for item in page:
+            if all(found.get((tag, item['image_id']), 0) >= count for tag, count in others.items()):
+                yield item
+
+
+def query_tags(tags, limit=DEFAULT_LIMIT, next_token=None):
+    # tags is a list or {tag: minimum count}, see parse_constraints
+    constraints = parse_constraints(tags)
+    start_key = decode_token(next_token)
+    driver = choose_driver(constraints, start_key)
+    matches = iter_matches(constraints, start_key, page_size=max(limit, 25), driver=driver)
+    page, token = take_page(matches, limit, page_key_names(constraints, driver))
+    return [item['thumbnail_url'] for item in page], token
+
+
+def item_counts(item):
+    # objects per tag, from tag_counts or the legacy detection result; tags
+    # added by hand count once
+    counts = Counter(normalize_tag(t) for t in item_tags(item))
+    if isinstance(item.get('tags'), str):
+        return counts
+    for tag in counts:
+        counts[tag] = max(int(item.get('tag_counts', {}).get(tag, 1)), 1)
+    return counts
+
+
+def scan_tags(tags, total_segments=None):
+    # Fallback for deployments without the index and for ad-hoc admin
+    # queries. contains() on the JSON string is only a coarse filter to cut
+    # what comes back over the wire, the exact match is done here.
+    constraints = parse_constraints(tags)
+    from boto3.dynamodb.conditions import Attr
+    filter_expression = None
+    for tag in constraints:
+        condition = Attr('tags').contains(tag)
+        filter_expression = condition if filter_expression is None else filter_expression & condition
+
+    fields = ['id', 'thumbnail_url', 's3_url', 'tags', 'tag_counts']
+    items = parallel_scan(image_table, fields, filter_expression, total_segments)
+    matches = []
+    for item in items:
+        counts = item_counts(item)
+        if all(counts.get(tag, 0) >= count for tag, count in constraints.items()):
+            item.pop('tag_counts', None)
+            matches.append(item)
+    return matches
+
+
+def backfill():
+    # one-off population of the index from the existing image table
+    # (also run it again to add the object counts to older postings)
+    kwargs = {
+        'ProjectionExpression': '#id, thumbnail_url, #tags, tag_counts',
+        'ExpressionAttributeNames': {'#id': 'id', '#tags': 'tags'}
+    }
+    count = 0
+    for item in iter_items(image_table.scan, **kwargs):
+        add_postings(item['id'], item_tags(item), item['thumbnail_url'], item_counts(item))
+        count += 1
+    bump_all()
+    print(f"[INFO] Indexed tags of {count} images into {TAG_INDEX_TABLE}")
+
+
+if __name__ == '__main__':
+    backfill()
@@ -1,10 +1,15 @@
 import json
-import boto3
-from boto3.dynamodb.conditions import Key
+import aws_clients
+from http_cache import conditional
+from instrumentation import instrumented
 
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table('database')
+table = aws_clients.table('database')
 
+# A thumbnail always maps to the same original, so a lookup may be reused
+# for a day by the browser and any CDN. Deleted images are the exception.
+LOOKUP_CACHE_CONTROL = 'public, max-age=86400'
+
+@instrumented
 def lambda_handler(event, context):
     if event['httpMethod'] == 'OPTIONS':
         return {
@@ -17,7 +22,7 @@ def lambda_handler(event, context):
             'body': json.dumps('CORS preflight response')
         }
     
-    if event['httpMethod'] != 'POST':
+    if event['httpMethod'] not in ('GET', 'POST'):
         return {
             'statusCode': 405,
             'headers': {
@@ -28,7 +33,12 @@ def lambda_handler(event, context):
             'body': json.dumps('Method Not Allowed')
         }
     
-    body = json.loads(event['body'])
+    # GET /thumbnail?thumbnail_url=... can be cached, POST is kept for
+    # older clients
+    if event['httpMethod'] == 'GET':
+        body = event.get('queryStringParameters') or {}
+    else:
+        body = json.loads(event['body'])
     thumbnail_url = body.get('thumbnail_url')
     
     if not thumbnail_url:
@@ -43,6 +53,7 @@ def lambda_handler(event, context):
         }
     
     # Query using the GSI on thumbnail_url
+    from boto3.dynamodb.conditions import Key
     response = table.query(
         IndexName='thumbnail_url-index',  # Replace with the actual GSI index name
         KeyConditionExpression=Key('thumbnail_url').eq(thumbnail_url)
@@ -62,7 +73,7 @@ def lambda_handler(event, context):
     item = response['Items'][0]
     full_image_url = item['s3_url']
     
-    return {
+    return conditional(event, {
         'statusCode': 200,
         'headers': {
             'Access-Control-Allow-Origin': '*',
@@ -70,4 +81,4 @@ def lambda_handler(event, context):
             'Access-Control-Allow-Methods': '*'
         },
         'body': json.dumps({'full_image_url': full_image_url})
-    }
\ No newline at end of file
+    }, LOOKUP_CACHE_CONTROL)
\ No newline at end of file
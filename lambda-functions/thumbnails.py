@@ -0,0 +1,120 @@
+import base64
+import os
+import struct
+
+import cv2
+import numpy as np
+
+# longest side of every rendition, the first one is the primary thumbnail
+THUMBNAIL_SIZES = [int(size) for size in os.environ.get('THUMBNAIL_SIZES', '128,256,512').split(',')]
+JPEG_QUALITY = int(os.environ.get('THUMBNAIL_JPEG_QUALITY', '85'))
+WEBP_ENABLED = os.environ.get('THUMBNAIL_WEBP', '0') == '1'
+WEBP_QUALITY = int(os.environ.get('THUMBNAIL_WEBP_QUALITY', '80'))
+
+# The detector squashes every image to a square blob, so a pre-resized
+# square JPEG is all it needs. Kept well below the 256 KB SNS/SQS limit.
+DETECTION_SIZE = 416
+DETECTION_JPEG_QUALITY = 95
+MAX_DETECTION_INPUT_BYTES = 180 * 1024
+
+REDUCED_MODES = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+]
+
+# JPEG start-of-frame markers that carry the image dimensions
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def read_image_size(data):
+    # (width, height) from the PNG or JPEG header, None for anything else
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        return struct.unpack('>II', data[16:24])
+    if data[:2] == b'\xff\xd8':
+        i = 2
+        while i + 9 < len(data):
+            if data[i] != 0xFF:
+                i += 1
+                continue
+            marker = data[i + 1]
+            if marker == 0xFF:
+                i += 1
+                continue
+            if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+                i += 2
+                continue
+            length = struct.unpack('>H', data[i + 2:i + 4])[0]
+            if marker in _SOF_MARKERS:
+                height, width = struct.unpack('>HH', data[i + 5:i + 9])
+                return width, height
+            i += 2 + length
+    return None
+
+
+def decode_image(data, min_side=None, min_short_side=0):
+    # Decode at the strongest power-of-two reduction that still leaves the
+    # longest side at least min_side (and the shortest min_short_side)
+    # pixels. libjpeg does the reduction while decoding, so large camera
+    # images never exist at full size.
+    np_array = np.frombuffer(data, np.uint8)
+    flags = cv2.IMREAD_COLOR
+    size = read_image_size(data) if min_side else None
+    if size:
+        for factor, mode in REDUCED_MODES:
+            if max(size) // factor >= min_side and min(size) // factor >= min_short_side:
+                flags = mode
+                break
+    return cv2.imdecode(np_array, flags)
+
+
+def fit(image, size):
+    # aspect preserving resize so the longest side is at most size
+    (H, W) = image.shape[:2]
+    scale = size / max(H, W)
+    if scale >= 1:
+        return image
+    return cv2.resize(image, (max(1, round(W * scale)), max(1, round(H * scale))), interpolation=cv2.INTER_AREA)
+
+
+def make_renditions(image, sizes=None):
+    # largest first, each one resized from the previous to keep the work small
+    renditions = {}
+    for size in sorted(sizes or THUMBNAIL_SIZES, reverse=True):
+        image = fit(image, size)
+        renditions[size] = image
+    return renditions
+
+
+def encode(image, fmt='jpeg'):
+    if fmt == 'webp':
+        _, buffer = cv2.imencode('.webp', image, [cv2.IMWRITE_WEBP_QUALITY, WEBP_QUALITY])
+    else:
+        _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    return buffer.tobytes()
+
+
+def output_formats():
+    return ['jpeg', 'webp'] if WEBP_ENABLED else ['jpeg']
+
+
+def rendition_settings():
+    # Everything besides the source that changes the bytes of a rendition:
+    # every size (each rendition is resized from the next larger one), the
+    # decode reduction, which also depends on the detection size, the
+    # encoder qualities and the OpenCV build doing all of it
+    return (f"sizes={','.join(map(str, sorted(THUMBNAIL_SIZES)))};detection={DETECTION_SIZE};"
+            f"jpeg={JPEG_QUALITY};webp={WEBP_QUALITY};opencv={cv2.__version__}")
+
+
+def encode_detection_input(image):
+    # base64 JPEG of the image squashed to the detector input size, or None
+    # when it would not fit in a message
+    resized = cv2.resize(image, (DETECTION_SIZE, DETECTION_SIZE), interpolation=cv2.INTER_AREA)
+    _, buffer = cv2.imencode('.jpg', resized, [cv2.IMWRITE_JPEG_QUALITY, DETECTION_JPEG_QUALITY])
+    payload = base64.b64encode(buffer.tobytes()).decode()
+    return payload if len(payload) <= MAX_DETECTION_INPUT_BYTES else None
+
+
+def decode_detection_input(payload):
+    return cv2.imdecode(np.frombuffer(base64.b64decode(payload), np.uint8), cv2.IMREAD_COLOR)
@@ -1,10 +1,97 @@
 import json
-import boto3
-from boto3.dynamodb.conditions import Key
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import aws_clients
+from botocore.exceptions import ClientError
+from instrumentation import instrumented
+from query_cache import bump
+from tag_index import add_postings, item_counts, item_tags, normalize_tag, remove_postings
+from vector_feed import record_change
 
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table('database')
+table = aws_clients.table('database')
+# the low level client is thread safe, the resource Table is not
+client = aws_clients.resource_client('dynamodb')
 
+UPDATE_WORKERS = 16
+
+def find_item_id(url):
+    from boto3.dynamodb.conditions import Key
+    # Query using the GSI on thumbnail_url to get the item
+    response = client.query(
+        TableName=table.name,
+        IndexName='thumbnail_url-index',
+        KeyConditionExpression=Key('thumbnail_url').eq(url)
+    )
+    items = response.get('Items', [])
+    return items[0]['id'] if items else None
+
+def migrate_legacy_tags(item_id):
+    # Items written before tags became a string set hold the JSON encoded
+    # detection result. Convert it in place, guarded on the old value so a
+    # concurrent migration or edit is never overwritten.
+    item = client.get_item(TableName=table.name, Key={'id': item_id}).get('Item', {})
+    old = item.get('tags')
+    if not isinstance(old, str):
+        return
+    counts = Counter(normalize_tag(tag) for tag in item_tags(item))
+    values = {':old': old, ':counts': dict(counts)}
+    if counts:
+        update = 'SET #tags = :tags, tag_counts = if_not_exists(tag_counts, :counts)'
+        values[':tags'] = set(counts)
+    else:
+        update = 'SET tag_counts = if_not_exists(tag_counts, :counts) REMOVE #tags'
+    try:
+        client.update_item(
+            TableName=table.name,
+            Key={'id': item_id},
+            UpdateExpression=update,
+            ConditionExpression='#tags = :old',
+            ExpressionAttributeNames={'#tags': 'tags'},
+            ExpressionAttributeValues=values
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+def apply_tags(item_id, tags, action_type):
+    # ADD/DELETE on a string set is applied atomically by DynamoDB: no read
+    # round trip, no duplicates and no lost update under concurrent edits.
+    # Returns None when the image was deleted since it was looked up.
+    kwargs = {
+        'TableName': table.name,
+        'Key': {'id': item_id},
+        'UpdateExpression': ('ADD' if action_type == 1 else 'DELETE') + ' #tags :tags',
+        # ADD and DELETE would otherwise create an item with nothing but tags
+        'ConditionExpression': 'attribute_exists(id)',
+        'ExpressionAttributeNames': {'#tags': 'tags'},
+        'ExpressionAttributeValues': {':tags': tags},
+        'ReturnValues': 'ALL_NEW'
+    }
+    try:
+        try:
+            response = client.update_item(**kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ValidationException':
+                raise
+            migrate_legacy_tags(item_id)
+            response = client.update_item(**kwargs)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return None
+    return response.get('Attributes', {})
+
+def update_url(url, tags, action_type):
+    item_id = find_item_id(url)
+    if item_id is None:
+        return {'url': url, 'status': 'not_found'}
+    item = apply_tags(item_id, tags, action_type)
+    if item is None:
+        return {'url': url, 'status': 'not_found'}
+    return {'url': url, 'status': 'updated', 'id': item_id, 'tags': sorted(item.get('tags', set())),
+            'counts': item_counts(item)}
+
+@instrumented
 def lambda_handler(event, context):
     # Extract body from event and parse it as JSON
     body = json.loads(event.get('body', '{}'))
@@ -12,6 +99,12 @@ def lambda_handler(event, context):
     tags = body.get('tags', [])
     action_type = body.get('type')  # 1 for add, 0 for remove
 
+    if isinstance(urls, str):
+        urls = [urls]
+    if isinstance(tags, str):
+        tags = [tags]
+    tags = {normalize_tag(tag) for tag in tags} - {''}
+
     if not urls or not tags or action_type not in [0, 1]:
         return {
             'statusCode': 400,
@@ -24,55 +117,52 @@ def lambda_handler(event, context):
             },
         }
 
-    for url in urls:
-        # Query using the GSI on thumbnail_url to get the item
-        response = table.query(
-            IndexName='thumbnail_url-index',  # Replace with the actual GSI index name
-            KeyConditionExpression=Key('thumbnail_url').eq(url)
-        )
+    # Look up and update every URL concurrently
+    urls = list(dict.fromkeys(urls))
+    results = []
+    with ThreadPoolExecutor(max_workers=UPDATE_WORKERS) as pool:
+        for url, future in [(url, pool.submit(update_url, url, tags, action_type)) for url in urls]:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append({'url': url, 'status': 'error', 'error': str(e)})
 
-        if 'Items' not in response or len(response['Items']) == 0:
+    # Keep the tag index in step with the items that were updated
+    for result in results:
+        if result['status'] != 'updated':
             continue
+        try:
+            if action_type == 1:
+                # keeps the detected object counts of tags the image already had
+                add_postings(result['id'], tags, result['url'], result['counts'])
+            else:
+                remove_postings(result['id'], tags)
+        except Exception as e:
+            result['status'] = 'error'
+            result['error'] = f'Tags updated but tag index write failed: {str(e)}'
+            continue
+        # the similarity index picks the edit up on its next refresh, a
+        # failure here only delays it until the next full rebuild
+        try:
+            record_change(result['id'], result['url'], result['counts'])
+        except Exception as e:
+            print(f"[WARN] Could not record the similarity change of {result['url']}: {e}")
 
-        item = response['Items'][0]
-        item_id = item['id']
-        c_tags = item['tags']
-        current_tags = json.loads(c_tags)['tags']
-
-        # Ensure current_tags is a list
-        if not isinstance(current_tags, list):
-            current_tags = []
-
-        # Update the current_tags based on the action type
-        if action_type == 1:
-            # Add tags
-            current_tags.extend(tags)
-        elif action_type == 0:
-            # Remove tags
-            for tag in tags:
-                if tag in current_tags:
-                    current_tags.remove(tag)
-
-        # Convert updated tags to JSON string
-        new_tags = {"tags": current_tags}
-        updated_tags = json.dumps(new_tags)
+    # cached searches for the edited tags are out of date now
+    if any(result['status'] != 'not_found' for result in results):
+        bump(tags)
 
-        # Update the item in DynamoDB
-        table.update_item(
-            Key={'id': item_id},
-            UpdateExpression='SET tags = :val1',
-            ExpressionAttributeValues={
-                ':val1': updated_tags
-            }
-        )
+    for result in results:
+        result.pop('counts', None)
 
+    failed = any(result['status'] != 'updated' for result in results)
     return {
-        'statusCode': 200,
-        'body': json.dumps('Tags updated successfully'),
+        'statusCode': 207 if failed else 200,
+        'body': json.dumps({'results': results}),
         'headers': {
             'Content-Type': 'application/json',
             'Access-Control-Allow-Origin': '*',
             'Access-Control-Allow-Methods': '*',
             'Access-Control-Allow-Headers': '*'
         },
-    }
\ No newline at end of file
+    }
@@ -1,11 +1,13 @@
 import json
-import boto3
+import aws_clients
 from base64 import b64decode
 from io import BytesIO
 from botocore.exceptions import ClientError
+from instrumentation import instrumented, record_size, stage
 
-s3_client = boto3.client('s3')
+s3_client = aws_clients.client('s3')
 
+@instrumented
 def lambda_handler(event, context):
   # Get the base64 encoded image and image name from the request body
   try:
@@ -19,9 +21,14 @@ def lambda_handler(event, context):
       'body': json.dumps('Request body must contain "user_email", "image" and "image_name" keys')
     }
 
+  # the image comes in the event itself, not in a body the decorator sees
+  record_size('request', len(encoded_image))
+
   # Decode the base64 image data
   try:
-    decoded_image_data = b64decode(encoded_image)
+    with stage('decode'):
+      decoded_image_data = b64decode(encoded_image)
+    record_size('image', len(decoded_image_data))
   except Exception as e:
     print(f"Error decoding base64 image: {e}")
     return {
@@ -31,7 +38,8 @@ def lambda_handler(event, context):
 
   # Upload the decoded image to S3
   try:
-    s3_client.put_object(Body=BytesIO(decoded_image_data), Bucket='5225-a3-image', Key=image_name, Metadata={"user_email":user_email})
+    with stage('s3_put'):
+      s3_client.put_object(Body=BytesIO(decoded_image_data), Bucket='5225-a3-image', Key=image_name, Metadata={"user_email":user_email})
     return {
       'statusCode': 200,
       'body': json.dumps(f'Image "{image_name}" uploaded successfully!')
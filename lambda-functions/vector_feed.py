@@ -0,0 +1,31 @@
+import time
+
+import aws_clients
+
+# Change feed of per-image class counts, partition key 'shard' (always
+# CHANGE_PARTITION), sort key 'seq' ("<epoch ms>#<image id>"). An item
+# without 'tag_counts' removes the image. Rows expire through the TTL on
+# 'expires_at', a full rebuild from 'database' covers anything older.
+# Kept apart from similarity_index so writers do not load NumPy.
+CHANGES_TABLE = 'image-vectors'
+changes_table = aws_clients.table(CHANGES_TABLE)
+CHANGE_PARTITION = 'changes'
+CHANGE_TTL_SECONDS = 24 * 3600
+
+
+def change_item(image_id, thumbnail_url=None, counts=None):
+    now = time.time()
+    item = {
+        'shard': CHANGE_PARTITION,
+        'seq': f'{int(now * 1000):013d}#{image_id}',
+        'image_id': image_id,
+        'expires_at': int(now) + CHANGE_TTL_SECONDS
+    }
+    if thumbnail_url is not None:
+        item['thumbnail_url'] = thumbnail_url
+        item['tag_counts'] = {tag: int(count) for tag, count in (counts or {}).items()}
+    return item
+
+
+def record_change(image_id, thumbnail_url, counts):
+    changes_table.put_item(Item=change_item(image_id, thumbnail_url, counts))
@@ -0,0 +1,194 @@
+import hashlib
+import os
+import time
+
+import cv2
+import numpy as np
+
+import aws_clients
+from inference_profiles import get_profile
+from instrumentation import record, stage
+from yolo_postprocess import postprocess
+
+s3_client = aws_clients.client('s3')
+
+DETECTION_BUCKET = '5225-a3-detection-files'
+YOLO_FILES = ['coco.names', 'yolov3-tiny.cfg', 'yolov3-tiny.weights']
+MODEL_DIR = '/tmp'
+
+# Loaded once per container (per profile) and reused by every invocation
+# that lands on it.
+_models = {}
+
+
+class YoloModel:
+    def __init__(self, net, labels, output_layers, profile=None):
+        self.net = net
+        self.labels = labels
+        self.output_layers = output_layers
+        self.profile = profile or get_profile()
+
+    def forward(self, blob):
+        # raw YOLO layer outputs for the blob
+        self.net.setInput(blob)
+        return self.net.forward(self.output_layers)
+
+
+class OnnxRuntimeModel:
+    # An ONNX export with the raw YOLO output layers, (batch, rows, 85)
+    # each, run by onnxruntime's CPU provider
+    def __init__(self, session, labels, profile):
+        self.session = session
+        self.labels = labels
+        self.profile = profile
+        self.input_name = session.get_inputs()[0].name
+        self.fixed_batch = session.get_inputs()[0].shape[0] == 1
+
+    def forward(self, blob):
+        if self.fixed_batch and len(blob) > 1:
+            # exported without a dynamic batch axis: one run per image
+            runs = [self.session.run(None, {self.input_name: blob[i:i + 1]}) for i in range(len(blob))]
+            return [np.concatenate([run[layer] for run in runs]) for layer in range(len(runs[0]))]
+        return self.session.run(None, {self.input_name: blob})
+
+
+def model_files(profile):
+    if profile.onnx_model:
+        return ['coco.names', profile.onnx_model]
+    return YOLO_FILES
+
+
+def _local_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _is_current(path, etag):
+    # /tmp survives between invocations (and sometimes re-inits) of the same
+    # sandbox, so only download when the local copy does not match S3.
+    if not os.path.exists(path):
+        return False
+    etag_path = path + '.etag'
+    if os.path.exists(etag_path):
+        with open(etag_path) as f:
+            return f.read().strip() == etag
+    # Single part uploads use the MD5 of the object as ETag
+    if '-' not in etag:
+        return _local_md5(path) == etag
+    return False
+
+
+def download_yolo_files(files=YOLO_FILES):
+    downloaded = []
+    for file_name in files:
+        path = os.path.join(MODEL_DIR, file_name)
+        head = s3_client.head_object(Bucket=DETECTION_BUCKET, Key=file_name)
+        etag = head['ETag'].strip('"')
+        if _is_current(path, etag):
+            continue
+        s3_client.download_file(DETECTION_BUCKET, file_name, path)
+        with open(path + '.etag', 'w') as f:
+            f.write(etag)
+        downloaded.append(file_name)
+    return downloaded
+
+
+def load_model(configpath, weightspath):
+    # load our YOLO object detector trained on COCO dataset (80 classes)
+    print("[INFO] loading YOLO from disk...")
+    net = cv2.dnn.readNetFromDarknet(configpath, weightspath)
+    return net
+
+
+def load_onnx(path, profile):
+    try:
+        import onnxruntime
+    except ImportError:
+        # optional dependency, cv2.dnn runs the same export
+        return None
+    options = onnxruntime.SessionOptions()
+    if profile.threads:
+        options.intra_op_num_threads = profile.threads
+    return onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+
+def build_model(profile, model_dir=MODEL_DIR):
+    # the model of a profile from files already in model_dir
+    with open(os.path.join(model_dir, 'coco.names')) as f:
+        labels = f.read().strip().split("\n")
+    if profile.threads:
+        cv2.setNumThreads(profile.threads)
+
+    if profile.onnx_model:
+        path = os.path.join(model_dir, profile.onnx_model)
+        session = load_onnx(path, profile)
+        if session is not None:
+            return OnnxRuntimeModel(session, labels, profile)
+        net = cv2.dnn.readNetFromONNX(path)
+    else:
+        net = load_model(os.path.join(model_dir, 'yolov3-tiny.cfg'),
+                         os.path.join(model_dir, 'yolov3-tiny.weights'))
+
+    # determine only the *output* layer names that we need from YOLO
+    return YoloModel(net, labels, net.getUnconnectedOutLayersNames(), profile)
+
+
+def get_model(profile=None):
+    profile = profile or get_profile()
+    if profile.name in _models:
+        print("[INFO] YOLO model warm, reusing cached net")
+        return _models[profile.name]
+
+    start = time.time()
+    downloaded = download_yolo_files(model_files(profile))
+    download_end = time.time()
+
+    model = build_model(profile)
+    end = time.time()
+
+    print("[INFO] YOLO model ({} profile) cold load took {:.6f} seconds "
+          "(download {:.6f}s for {}, parse {:.6f}s)".format(
+              profile.name, end - start, download_end - start, downloaded or 'nothing',
+              end - download_end))
+
+    _models[profile.name] = model
+    return model
+
+
+def split_batch_outputs(layerOutputs, batch_size):
+    # With a single image every YOLO output layer is (rows, 85). For a batch
+    # OpenCV either adds a leading batch axis or stacks the rows of every
+    # image one after the other, depending on the version.
+    per_image = [[] for _ in range(batch_size)]
+    for output in layerOutputs:
+        if output.ndim == 3:
+            chunks = output
+        else:
+            chunks = output.reshape(batch_size, -1, output.shape[-1])
+        for i in range(batch_size):
+            per_image[i].append(chunks[i])
+    return per_image
+
+
+def predict(images, model):
+    # construct a single blob from all the input images, sized for the
+    # model's profile, and then perform one forward pass of the YOLO object
+    # detector for the whole batch, giving us our bounding boxes and
+    # associated probabilities; one postprocess() result per image
+    profile = model.profile
+    size = (profile.input_size, profile.input_size)
+    with stage('blob'):
+        blob = cv2.dnn.blobFromImages(images, 1 / 255.0, size, swapRB=True, crop=False)
+    record('batch_size', len(images))
+    with stage('forward'):
+        layerOutputs = model.forward(blob)
+
+    results = []
+    for image, outputs in zip(images, split_batch_outputs(layerOutputs, len(images))):
+        (H, W) = image.shape[:2]
+        with stage('postprocess'):
+            results.append(postprocess(outputs, W, H, model.labels, **profile.thresholds))
+    return results
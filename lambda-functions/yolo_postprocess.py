@@ -0,0 +1,63 @@
+import cv2
+import numpy as np
+
+from instrumentation import stage
+
+# minimum class probability to keep a detection and the NMS overlap threshold
+confthres = 0.3
+nmsthres = 0.1
+# ignore detected objects with an accuracy of detection below this
+tagthres = 0.5
+
+
+def decode_detections(layerOutputs, W, H, confthres=confthres):
+    # stack every output layer into a single (rows, 5 + classes) array so the
+    # whole image is decoded with a handful of array operations
+    detections = np.concatenate([output.reshape(-1, output.shape[-1]) for output in layerOutputs])
+
+    # extract the class ID and confidence (i.e., probability) of every row
+    scores = detections[:, 5:]
+    classIDs = scores.argmax(axis=1)
+    confidences = np.take_along_axis(scores, classIDs[:, None], axis=1)[:, 0]
+
+    # filter out weak predictions before doing any box arithmetic
+    keep = confidences > confthres
+    detections = detections[keep]
+    classIDs = classIDs[keep]
+    confidences = confidences[keep]
+
+    # scale the bounding box coordinates back relative to the size of the
+    # image, YOLO returns the center (x, y)-coordinates of the bounding box
+    # followed by the boxes' width and height
+    box = (detections[:, 0:4] * np.array([W, H, W, H], dtype=detections.dtype)).astype("int")
+    centerX, centerY, width, height = box.T
+
+    # use the center (x, y)-coordinates to derive the top and left corner
+    x = (centerX - width / 2).astype("int")
+    y = (centerY - height / 2).astype("int")
+    boxes = np.stack([x, y, width, height], axis=1)
+
+    return boxes, confidences, classIDs
+
+
+def postprocess(layerOutputs, W, H, LABELS, confthres=confthres, nmsthres=nmsthres, tagthres=tagthres):
+    # the thresholds default to the module globals, inference profiles may
+    # override them
+    boxes, confidences, classIDs = decode_detections(layerOutputs, W, H, confthres)
+
+    results = {"tags": []}
+    if len(boxes) == 0:
+        return results
+
+    # apply non-maxima suppression to suppress weak, overlapping bounding boxes
+    with stage('nms'):
+        idxs = cv2.dnn.NMSBoxes(boxes.tolist(), confidences.tolist(), confthres, nmsthres)
+
+    # ensure at least one detection exists
+    if len(idxs) > 0:
+        for i in np.asarray(idxs).flatten():
+            if confidences[i] < tagthres:
+                continue
+            results["tags"].append(LABELS[classIDs[i]])
+
+    return results
@@ -1,14 +1,16 @@
 import json
-import boto3
+import aws_clients
 from base64 import b64decode
 from io import BytesIO
 from botocore.exceptions import ClientError
+from instrumentation import instrumented, log_event, record_size, stage
 
-s3_client = boto3.client('s3')
+s3_client = aws_clients.client('s3')
 
+@instrumented
 def lambda_handler(event, context):
-    # Log the incoming event for debugging
-    print("Received event: " + json.dumps(event, indent=2))
+    # Log the incoming event for debugging, without the base64 image
+    log_event(event)
 
     # Handle CORS preflight request
     if event['httpMethod'] == 'OPTIONS':
@@ -42,7 +44,9 @@ def lambda_handler(event, context):
 
     # Decode the base64 image data
     try:
-        decoded_image_data = b64decode(encoded_image)
+        with stage('decode'):
+            decoded_image_data = b64decode(encoded_image)
+        record_size('image', len(decoded_image_data))
     except Exception as e:
         print(f"Error decoding base64 image: {e}")
         return {
@@ -57,12 +61,13 @@ def lambda_handler(event, context):
 
     # Upload the decoded image to S3
     try:
-        s3_client.put_object(
-            Body=BytesIO(decoded_image_data),
-            Bucket='5225-a3-image',
-            Key=image_name,
-            Metadata={"user_email": user_email}
-        )
+        with stage('s3_put'):
+            s3_client.put_object(
+                Body=BytesIO(decoded_image_data),
+                Bucket='5225-a3-image',
+                Key=image_name,
+                Metadata={"user_email": user_email}
+            )
         return {
             'statusCode': 200,
             'headers': {
@@ -1,52 +1,141 @@
 import json
-import boto3
-from boto3.dynamodb.conditions import Attr
+from concurrent.futures import ThreadPoolExecutor
+import aws_clients
+from botocore.exceptions import ClientError
+from instrumentation import instrumented
 
-dynamodb = boto3.resource('dynamodb')
 USER_SUBSCRIPTIONS_TABLE = 'user-tags'
+table = aws_clients.table(USER_SUBSCRIPTIONS_TABLE)
+# 低层 client 是线程安全的, resource 的 Table 不是
+client = aws_clients.resource_client('dynamodb')
 
-def lambda_handler(event, context):
-    headers = {
-        'Content-Type': 'application/json',
-        'Access-Control-Allow-Origin': '*',
-        'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
-        'Access-Control-Allow-Headers': '*'
+SUBSCRIBE_WORKERS = 16
+
+headers = {
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
+    'Access-Control-Allow-Headers': '*'
+}
+
+def normalize_tags(tags):
+    if isinstance(tags, str):
+        tags = [tags]
+    return {tag.strip().lower() for tag in tags} - {''}
+
+def migrate_legacy_tags(user_email):
+    # 旧的订阅存成列表 (L), ADD/DELETE 只能作用于字符串集合 (SS)。
+    # 原地转换, 条件是值没变, 不会覆盖并发的修改
+    item = client.get_item(TableName=table.name, Key={'id': user_email}).get('Item', {})
+    old = item.get('subscribed_tags')
+    if not isinstance(old, list):
+        return
+    new_tags = normalize_tags(old)
+    if new_tags:
+        update = 'SET #tags = :tags'
+        values = {':old': old, ':tags': new_tags}
+    else:
+        update = 'REMOVE #tags'
+        values = {':old': old}
+    try:
+        client.update_item(
+            TableName=table.name,
+            Key={'id': user_email},
+            UpdateExpression=update,
+            ConditionExpression='#tags = :old',
+            ExpressionAttributeNames={'#tags': 'subscribed_tags'},
+            ExpressionAttributeValues=values
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+def apply_subscription(user_email, tags, action):
+    # 一次 update_item 完成: ADD/DELETE 字符串集合由 DynamoDB 原子执行,
+    # 不用先读, 并发订阅也不会互相覆盖。用户不存在时 ADD 会创建记录。
+    # 返回 None 表示退订的用户不存在
+    kwargs = {
+        'TableName': table.name,
+        'Key': {'id': user_email},
+        'UpdateExpression': ('DELETE' if action == 'unsubscribe' else 'ADD') + ' #tags :tags',
+        'ExpressionAttributeNames': {'#tags': 'subscribed_tags'},
+        'ExpressionAttributeValues': {':tags': tags},
+        'ReturnValues': 'UPDATED_NEW'
     }
-    
+    if action == 'unsubscribe':
+        # DELETE 也会创建不存在的记录, stream 会把它当成新用户 (INSERT),
+        # automatic.py 随后订阅 SNS 并发送欢迎邮件
+        kwargs['ConditionExpression'] = 'attribute_exists(id)'
+    try:
+        try:
+            response = client.update_item(**kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ValidationException':
+                raise
+            migrate_legacy_tags(user_email)
+            response = client.update_item(**kwargs)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return None
+    return response.get('Attributes', {}).get('subscribed_tags', set())
+
+def parse_subscriptions(body):
+    # 单个用户: {"user_email": ..., "subscribed_tags": [...]}
+    # 批量导入: {"subscriptions": [{"user_email": ..., "subscribed_tags": [...]}, ...]}
+    # 同一个用户出现多次时合并成一次写入
+    entries = body.get('subscriptions') or [body]
+    subscriptions = {}
+    for entry in entries:
+        user_email = entry.get('user_email')
+        tags = normalize_tags(entry.get('subscribed_tags', entry.get('tags', [])))
+        if not user_email or not tags:
+            raise ValueError('user_email and subscribed_tags are required')
+        subscriptions.setdefault(user_email, set()).update(tags)
+    return subscriptions
+
+@instrumented
+def lambda_handler(event, context):
+    if event.get('httpMethod') == 'OPTIONS':
+        return {'statusCode': 200, 'headers': headers, 'body': json.dumps('OK')}
+
     # 从事件对象中获取用户信息
     # user_email = event['requestContext']['claims']['email']
-    body = json.loads(event['body'])
-    new_tags = body['subscribed_tags']
-    user_email = body['user_email']
-    
-    # 获取 DynamoDB 表
-    table = dynamodb.Table(USER_SUBSCRIPTIONS_TABLE)
-    
-    # 检查用户是否已有订阅
-    response = table.get_item(Key={'id': user_email})
-    
-    if 'Item' in response:
-        # 用户已有订阅，合并新的标签
-        existing_tags = set(response['Item']['subscribed_tags'])
-        print(existing_tags)
-        updated_tags = list(existing_tags.union(new_tags))  # 合并集合，并转换回列表以供DynamoDB使用
-        # 更新 DynamoDB 表中的订阅信息
-        table.update_item(
-            Key={'id': user_email},
-            UpdateExpression='SET subscribed_tags = :updated_tags', # SET 表示更新，将属性subscribed_tags设置为参数:updated_tags的值
-            ExpressionAttributeValues={':updated_tags': updated_tags} # 更新表达式中使用的参数值为updated
-        )
-    else: 
-        # 用户没有订阅，创建新订阅
-        table.put_item(
-            Item={
-                'id': user_email,
-                'subscribed_tags': list(new_tags)  # 存储为列表，DynamoDB 自动处理为'SS'
-            }
-        )
-    
+    try:
+        body = json.loads(event.get('body') or '{}')
+        action = body.get('action', 'subscribe')
+        if action not in ['subscribe', 'unsubscribe']:
+            raise ValueError(f'Unknown action: {action}')
+        subscriptions = parse_subscriptions(body)
+    except (ValueError, AttributeError) as e:
+        return {
+            'statusCode': 400,
+            'headers': headers,
+            'body': json.dumps({'message': str(e)})
+        }
+
+    # BatchWriteItem 只能整条 put/delete, 不能 ADD, 所以批量时并发执行每个用户的 update_item
+    results = []
+    with ThreadPoolExecutor(max_workers=SUBSCRIBE_WORKERS) as pool:
+        futures = [(user_email, pool.submit(apply_subscription, user_email, tags, action))
+                   for user_email, tags in subscriptions.items()]
+        for user_email, future in futures:
+            try:
+                subscribed = future.result()
+                if subscribed is None:
+                    results.append({'user_email': user_email, 'status': 'not_found'})
+                else:
+                    results.append({'user_email': user_email, 'status': 'updated',
+                                    'subscribed_tags': sorted(subscribed)})
+            except Exception as e:
+                results.append({'user_email': user_email, 'status': 'error', 'error': str(e)})
+
+    failed = any(result['status'] != 'updated' for result in results)
     return {
-        'statusCode': 200,
+        'statusCode': 207 if failed else 200,
         'headers': headers,
-        'body': json.dumps({'message': 'Subscription updated successfully'})
+        'body': json.dumps({
+            'message': 'Subscription updated with errors' if failed else 'Subscription updated successfully',
+            'results': results
+        })
     }
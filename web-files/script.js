@@ -100,53 +100,97 @@ function protectPage() {
     }
 }
 
-async function uploadImage(imageFile, imageName, userEmail) {
-    const reader = new FileReader();
-    reader.readAsDataURL(imageFile);
-    reader.onload = async function() {
-        const base64Image = reader.result.split(',')[1];
-        const cognitoUser = JSON.parse(sessionStorage.getItem('cognitoUser'));
-
-        if (!cognitoUser || !cognitoUser.idToken || !cognitoUser.idToken.jwtToken) {
-            console.error('User is not authenticated');
-            throw new Error('User is not authenticated');
-        }
+async function requestUpload(payload, jwtToken) {
+    const response = await fetch(`${apiUrl}/upload_url`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'Authorization': jwtToken
+        },
+        body: JSON.stringify(payload)
+    });
 
-        const jwtToken = cognitoUser.idToken.jwtToken;
-        const payload = {
-            user_email: userEmail,
-            image: base64Image,
-            image_name: imageName
-        };
+    if (!response.ok) {
+        const errorData = await response.json();  // Get error response body
+        console.error('Upload failed:', errorData);
+        throw new Error('Upload failed: ' + (errorData.message || errorData || response.statusText));
+    }
 
-        console.log('Payload:', payload); // Log payload for debugging
+    return await response.json();
+}
 
-        const response = await fetch(`${apiUrl}/upload_image`, {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-                'Authorization': jwtToken
-            },
-            body: JSON.stringify(payload)
-        });
+// Upload the file straight to S3 with presigned URLs handed out by the API,
+// in parts for large files, then tell the API the upload is complete.
+async function uploadImage(imageFile, imageName, userEmail) {
+    const cognitoUser = JSON.parse(sessionStorage.getItem('cognitoUser'));
+
+    if (!cognitoUser || !cognitoUser.idToken || !cognitoUser.idToken.jwtToken) {
+        console.error('User is not authenticated');
+        throw new Error('User is not authenticated');
+    }
 
+    const jwtToken = cognitoUser.idToken.jwtToken;
+    const upload = await requestUpload({
+        action: 'start',
+        user_email: userEmail,
+        image_name: imageName,
+        content_type: imageFile.type || 'application/octet-stream',
+        size: imageFile.size
+    }, jwtToken);
+
+    if (!upload.upload_id) {
+        const response = await fetch(upload.url, {
+            method: 'PUT',
+            headers: upload.headers,
+            body: imageFile
+        });
         if (!response.ok) {
-            const errorData = await response.json();  // Get error response body
-            console.error('Upload failed:', errorData);
-            throw new Error('Upload failed: ' + (errorData.message || response.statusText));
+            throw new Error('Upload failed: ' + response.statusText);
         }
+        return await requestUpload({ action: 'complete', image_name: upload.key }, jwtToken);
+    }
 
-        return await response.json();
-    };
+    // The bucket CORS configuration has to expose the ETag header
+    const parts = [];
+    const concurrency = 4;
+    let next = 0;
+    async function uploadParts() {
+        while (next < upload.parts.length) {
+            const part = upload.parts[next++];
+            const start = (part.part_number - 1) * upload.part_size;
+            const response = await fetch(part.url, {
+                method: 'PUT',
+                body: imageFile.slice(start, start + upload.part_size)
+            });
+            if (!response.ok) {
+                throw new Error(`Upload of part ${part.part_number} failed: ` + response.statusText);
+            }
+            parts.push({ PartNumber: part.part_number, ETag: response.headers.get('ETag') });
+        }
+    }
+
+    try {
+        await Promise.all(Array.from({ length: concurrency }, uploadParts));
+    } catch (error) {
+        await requestUpload({ action: 'abort', image_name: upload.key, upload_id: upload.upload_id }, jwtToken);
+        throw error;
+    }
+
+    return await requestUpload({
+        action: 'complete',
+        image_name: upload.key,
+        upload_id: upload.upload_id,
+        parts: parts
+    }, jwtToken);
 }
 
-async function queryImagesByTags(tags) {
+async function queryImagesByTags(tags, nextToken = null, limit = 50) {
     const response = await fetch(`${apiUrl}/search`, {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json'
         },
-        body: JSON.stringify({ tags })
+        body: JSON.stringify({ tags, limit, next_token: nextToken })
     });
 
     if (!response.ok) {
@@ -156,16 +200,66 @@ async function queryImagesByTags(tags) {
     }
 
     const data = await response.json();
-    return data; // 返回解析后的JSON数据
+    return data; // { items: [...], next_token: '...' | null }
 }
 
-async function queryFullSizeImage(thumbnailUrl) {
-    const response = await fetch(`${apiUrl}/thumbnail?thumbnail_url=${encodeURIComponent(thumbnailUrl)}`, {
-        method: 'GET',
-        headers: {
-            'Content-Type': 'application/json'
+// "person, 2; dog" -> {person: 2, dog: 1}. A part of the form "tag, n"
+// asks for at least n of that tag, every other comma separated word is a
+// tag that must appear at least once.
+function parseTagQuery(input) {
+    const constraints = {};
+    input.split(';').forEach(part => {
+        const words = part.split(',').map(word => word.trim()).filter(word => word);
+        if (words.length === 2 && /^\d+$/.test(words[1])) {
+            constraints[words[0]] = Math.max(parseInt(words[1], 10), 1);
+            return;
         }
+        words.forEach(word => {
+            constraints[word] = constraints[word] || 1;
+        });
     });
+    return constraints;
+}
+
+// Follow the continuation tokens of the search endpoint, one page at a time
+async function* searchPages(tags, nextToken = null) {
+    do {
+        const data = await queryImagesByTags(tags, nextToken);
+        yield data.items;
+        nextToken = data.next_token;
+    } while (nextToken);
+}
+
+function appendThumbnails(resultsDiv, links) {
+    links.forEach(link => {
+        const img = document.createElement('img');
+        img.src = link;
+        img.alt = 'Image';
+        img.style.maxWidth = '200px';
+        img.style.margin = '10px';
+        resultsDiv.appendChild(img);
+    });
+}
+
+// A thumbnail always belongs to the same full size image, resolved URLs are
+// kept in localStorage and only looked up once per browser
+function cachedFullImageUrls() {
+    try {
+        return JSON.parse(localStorage.getItem('fullImageUrls')) || {};
+    } catch (error) {
+        return {};
+    }
+}
+
+async function queryFullSizeImage(thumbnailUrl) {
+    const known = cachedFullImageUrls();
+    if (known[thumbnailUrl]) {
+        return known[thumbnailUrl];
+    }
+
+    // a plain GET without custom headers needs no CORS preflight, and the
+    // browser and CDN may answer it from their caches
+    const response = await fetch(`${apiUrl}/thumbnail?thumbnail_url=${encodeURIComponent(thumbnailUrl)}`);
 
     if (!response.ok) {
         const errorData = await response.json();
@@ -174,6 +268,11 @@ async function queryFullSizeImage(thumbnailUrl) {
     }
 
     const data = await response.json();
+    try {
+        localStorage.setItem('fullImageUrls', JSON.stringify({ ...cachedFullImageUrls(), [thumbnailUrl]: data.full_image_url }));
+    } catch (error) {
+        // storage full or disabled, look it up again next time
+    }
     return data.full_image_url; // Get full image URL
 }
 
@@ -343,23 +442,18 @@ document.addEventListener("DOMContentLoaded", function() {
             queryForm.addEventListener('submit', async (event) => {
                 event.preventDefault();
                 const tagsInput = document.getElementById('tags').value;
-                const tags = tagsInput.split(',').map(tag => tag.trim());
+                const tags = parseTagQuery(tagsInput);
+                const resultsDiv = document.getElementById('results');
+                resultsDiv.innerHTML = '';
                 try {
-                    const result = await queryImagesByTags(tags);
-                    console.log('Query result:', result);
-                    const resultsDiv = document.getElementById('results');
-                    resultsDiv.innerHTML = '';
-                    if (Array.isArray(result)) {
-                        result.forEach(link => {
-                            const img = document.createElement('img');
-                            img.src = link;
-                            img.alt = 'Image';
-                            img.style.maxWidth = '200px';
-                            img.style.margin = '10px';
-                            resultsDiv.appendChild(img);
-                        });
-                    } else {
-                        resultsDiv.innerText = 'Unexpected result format';
+                    let found = 0;
+                    for await (const links of searchPages(tags)) {
+                        console.log('Query result page:', links);
+                        appendThumbnails(resultsDiv, links);
+                        found += links.length;
+                    }
+                    if (found === 0) {
+                        resultsDiv.innerText = 'No matching images found.';
                     }
                 } catch (error) {
                     console.error('Query error:', error);
@@ -374,13 +468,13 @@ document.addEventListener("DOMContentLoaded", function() {
                 event.preventDefault();
                 const thumbnailUrl = document.getElementById('thumbnail-url').value;
                 try {
-                    const result = await queryFullSizeImage(thumbnailUrl);
-                    console.log('Query result:', result);
+                    const fullImageUrl = await queryFullSizeImage(thumbnailUrl);
+                    console.log('Query result:', fullImageUrl);
                     const resultsDiv = document.getElementById('thumbnail-result');
                     resultsDiv.innerHTML = '';
-                    if (result.full_image_url) {
+                    if (fullImageUrl) {
                         const img = document.createElement('img');
-                        img.src = result.full_image_url;
+                        img.src = fullImageUrl;
                         img.alt = 'Full Size Image';
                         img.style.maxWidth = '400px';
                         img.style.margin = '10px';
@@ -432,14 +526,13 @@ document.addEventListener("DOMContentLoaded", function() {
                         resultsDiv.innerHTML = '';
 
                         if (Array.isArray(data.items) && data.items.length > 0) {
-                            data.items.forEach(item => {
-                                const img = document.createElement('img');
-                                img.src = item.thumbnail_url; // Assuming the response contains thumbnail_url for each item
-                                img.alt = 'Image';
-                                img.style.maxWidth = '200px';
-                                img.style.margin = '10px';
-                                resultsDiv.appendChild(img);
-                            });
+                            appendThumbnails(resultsDiv, data.items.map(item => item.thumbnail_url));
+                            // Remaining pages come from the tag search with the detected tags
+                            if (data.next_token) {
+                                for await (const links of searchPages(data.tags, data.next_token)) {
+                                    appendThumbnails(resultsDiv, links);
+                                }
+                            }
                         } else {
                             resultsDiv.innerText = 'No matching images found.';
                         }